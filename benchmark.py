@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# author: Tiancheng Zhao
+"""
+Micro and macro benchmarks of the simulator.
+
+For every DomainSpec in multiple_domains.py under CleanSpec and MixSpec, it reports the steady-state
+time per call of the main components and the dialogs/sec of Generator.gen as JSON. Given a baseline
+file, it fails if any throughput regresses by more than the threshold.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.2
+"""
+from simdial.agent.user import User
+from simdial.complexity import Complexity, CleanSpec, MixSpec
+from simdial.domain import Domain, DomainSpec
+from simdial.generator import Generator
+from simdial.profiler import StageProfiler
+import multiple_domains
+from timeit import default_timer as timer
+import numpy as np
+import argparse
+import json
+import sys
+
+COMPLEXITY_SPECS = [CleanSpec, MixSpec]
+
+# StageProfiler stage -> benchmark key
+STAGE_KEYS = {'sys.step': 'System.step',
+              'sys_nlg.generate_sent': 'SysNlg.generate_sent',
+              'usr.step': 'User.step',
+              'action_channel.transmit2sys': 'ActionChannel.transmit2sys',
+              'usr_nlg.generate_sent': 'UserNlg.generate_sent',
+              'word_channel.transmit2sys': 'WordChannel.transmit2sys'}
+
+
+class Timings(object):
+    """
+    Cumulative time and number of calls per benchmark key.
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, key, elapsed, calls=1):
+        total, cnt = self.totals.get(key, (0.0, 0))
+        self.totals[key] = (total + elapsed, cnt + calls)
+
+    def to_dict(self):
+        results = {}
+        for key, (total, cnt) in self.totals.items():
+            results[key] = {'calls': cnt, 'us_per_call': 1e6 * total / cnt, 'per_sec': cnt / total}
+        return results
+
+
+def get_domain_specs():
+    """
+    :return: all the DomainSpec classes defined in multiple_domains.py
+    """
+    specs = [v for v in vars(multiple_domains).values()
+             if isinstance(v, type) and issubclass(v, DomainSpec) and v is not DomainSpec]
+    return sorted(specs, key=lambda s: s.name)
+
+
+def time_components(domain, complexity, seed, num_warmup, num_dialogs, timings):
+    """
+    Time every stage of the generation loop in place with a StageProfiler. The first num_warmup dialogs
+    are not timed.
+    """
+    generator = Generator()
+    list(generator.iter_dialogs(domain, complexity, seed=seed, limit=num_warmup))
+    profiler = StageProfiler()
+    list(generator.iter_dialogs(domain, complexity, seed=seed, start=num_warmup, limit=num_dialogs,
+                                profiler=profiler))
+    for stage, key in STAGE_KEYS.items():
+        seconds, calls = profiler.totals[stage]
+        timings.add(key, seconds, calls)
+
+
+def time_database(domain, complexity, seed, num_calls, timings):
+    """
+    Time Database.select on the constrains of sampled user goals, once with the LRU cache off, so that every
+    call runs the select itself, and once with the cache warmed by the same queries (Database.select_cached).
+    Also time Database.sample_unique_row.
+    """
+    rng = np.random.RandomState(seed)
+    queries = []
+    for _ in range(100):
+        usr = User(domain, complexity, rng)
+        queries.append([usr.usr_constrains[s.name] for s in domain.usr_slots])
+    queries.append([None] * len(domain.usr_slots))
+
+    db = domain.db
+    cache_size = db.cache_size
+    db.clear_cache()
+    db.cache_size = 0
+    try:
+        for q in queries:
+            db.select(q)
+        t0 = timer()
+        for i in range(num_calls):
+            db.select(queries[i % len(queries)])
+        timings.add('Database.select', timer() - t0, num_calls)
+    finally:
+        db.cache_size = cache_size
+
+    for q in queries:
+        db.select(q)
+    t0 = timer()
+    for i in range(num_calls):
+        db.select(queries[i % len(queries)])
+    timings.add('Database.select_cached', timer() - t0, num_calls)
+
+    db.sample_unique_row(rng)
+    t0 = timer()
+    for _ in range(num_calls):
+        db.sample_unique_row(rng)
+    timings.add('Database.sample_unique_row', timer() - t0, num_calls)
+
+
+def time_generator(domain, complexity, seed, num_dialogs, repeats, timings):
+    """
+    Time the full Generator.gen loop and keep the best of the repeats.
+    """
+    generator = Generator()
+    list(generator.iter_dialogs(domain, complexity, seed=seed, limit=5))
+    best = None
+    for r in range(repeats):
+        t0 = timer()
+        list(generator.iter_dialogs(domain, complexity, seed=seed + r, limit=num_dialogs))
+        elapsed = timer() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    timings.add('Generator.gen', best, num_dialogs)
+
+
+def run(args):
+    results = {}
+    for domain_spec in get_domain_specs():
+        # one database per domain, shared by both complexities
+        domain = Domain(domain_spec(), seed=args.seed)
+        for complexity_spec in COMPLEXITY_SPECS:
+            complexity = Complexity(complexity_spec)
+            timings = Timings()
+            time_components(domain, complexity, args.seed, args.warmup, args.dialogs, timings)
+            time_database(domain, complexity, args.seed, args.calls, timings)
+            time_generator(domain, complexity, args.seed, args.dialogs, args.repeats, timings)
+            key = "%s/%s" % (domain_spec.name, complexity_spec.__name__)
+            results[key] = timings.to_dict()
+            sys.stderr.write("%s: %.1f dialogs/s\n" % (key, results[key]['Generator.gen']['per_sec']))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: a list of messages, one for every throughput that is more than threshold below the baseline
+    """
+    regressions = []
+    for key, metrics in sorted(baseline.items()):
+        for name, base in sorted(metrics.items()):
+            if name not in results.get(key, {}):
+                continue
+            current = results[key][name]['per_sec']
+            if current < base['per_sec'] * (1.0 - threshold):
+                regressions.append("%s %s: %.1f/s vs baseline %.1f/s (%.0f%%)"
+                                   % (key, name, current, base['per_sec'],
+                                      100.0 * (current / base['per_sec'] - 1.0)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SimDial components")
+    parser.add_argument('--output', help="write the results as JSON into this file instead of STDOUT")
+    parser.add_argument('--baseline', help="a previous output to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="the tolerated relative throughput drop against the baseline")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=20, help="untimed dialogs before measuring")
+    parser.add_argument('--dialogs', type=int, default=100, help="dialogs per measurement")
+    parser.add_argument('--repeats', type=int, default=3, help="repeats of the Generator.gen measurement")
+    parser.add_argument('--calls', type=int, default=2000, help="calls per Database measurement")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for msg in regressions:
+            sys.stderr.write("REGRESSION %s\n" % msg)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
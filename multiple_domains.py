@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
 from simdial.domain import Domain, DomainSpec
-from simdial.generator import Generator
-from simdial import complexity
+from simdial.scheduler import Scheduler
 import string
+import sys
+import os
 
 
 class RestSpec(DomainSpec):
@@ -292,51 +293,13 @@ class MovieSpec(DomainSpec):
 
 if __name__ == "__main__":
     # pipeline here
-    # generate a fix 500 test set and 5000 training set.
+    # generate a fix 500 test set and 2000 training set for each domain, as listed in multiple_domains.json.
     # generate them separately so the model can choose a subset for train and
     # test on all the test set to see generalization.
+    # the jobs run in parallel with one worker process per core.
 
-    test_size = 500
-    train_size = 2000
-    gen_bot = Generator()
-
-    rest_spec = RestSpec()
-    rest_style_spec = RestStyleSpec()
-    rest_pitt_spec = RestPittSpec()
-    bus_spec = BusSpec()
-    movie_spec = MovieSpec()
-    weather_spec = WeatherSpec()
-
-    # restaurant
-    gen_bot.gen_corpus("test", rest_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", rest_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", rest_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", rest_spec, complexity.MixSpec, train_size)
-
-    # restaurant style
-    gen_bot.gen_corpus("test", rest_style_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", rest_style_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", rest_style_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", rest_style_spec, complexity.MixSpec, train_size)
-
-    # bus
-    gen_bot.gen_corpus("test", bus_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", bus_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", bus_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", bus_spec, complexity.MixSpec, train_size)
-
-    # weather
-    gen_bot.gen_corpus("test", weather_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", weather_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", weather_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", weather_spec, complexity.MixSpec, train_size)
-
-    # movie
-    gen_bot.gen_corpus("test", movie_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", movie_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", movie_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", movie_spec, complexity.MixSpec, train_size)
-
-    # restaurant Pitt
-    gen_bot.gen_corpus("test", rest_pitt_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", rest_pitt_spec, complexity.MixSpec, train_size)
+    if len(sys.argv) > 1:
+        manifest = sys.argv[1]
+    else:
+        manifest = os.path.join(os.path.dirname(os.path.abspath(__file__)), "multiple_domains.json")
+    Scheduler.from_manifest(manifest).run()
@@ -2,7 +2,7 @@
 # author: Tiancheng Zhao
 
 import logging
-import copy
+import numpy as np
 
 
 class Agent(object):
@@ -10,9 +10,10 @@ class Agent(object):
     Abstract class for Agent (user or system)
     """
 
-    def __init__(self, domain, complexity):
+    def __init__(self, domain, complexity, rng=None):
         self.domain = domain
         self.complexity = complexity
+        self.rng = np.random if rng is None else rng
 
     def step(self, *args, **kwargs):
         """
@@ -23,27 +24,80 @@ class Agent(object):
         raise NotImplementedError("Implement step function is required")
 
 
-class Action(dict):
+class Action(object):
     """
     A generic class that corresponds to a discourse unit. An action is made of an Act and a list of parameters.
-    
-    :ivar act: dialog act String
-    :ivar parameters: [{slot -> usr_constrain}, {sys_slot -> value}] for INFORM, and [(type, value)...] for other acts. 
-    
+
+    Actions are immutable, so the dialog history, the channels and the NLG share them without copying. The
+    noise and the lexicalization build new actions with replace and with_parameter instead. An action only
+    holds its act code and a tuple of parameters, and it is turned into the {"act", "parameters"} dict of
+    the corpus by to_dict when the dialogs are written.
+
+    :ivar act: dialog act code of SystemAct or UserAct
+    :ivar parameters: [{slot -> usr_constrain}, {sys_slot -> value}] for INFORM, and [(type, value)...] for other acts.
+    The parameters are kept in a tuple and must not be modified either.
     """
 
+    __slots__ = ('act', 'parameters')
+
     def __init__(self, act, parameters=None):
-        self.act = act
         if parameters is None:
-            self.parameters = []
+            parameters = ()
         elif type(parameters) is not list:
-            self.parameters = [parameters]
+            parameters = (parameters,)
         else:
-            self.parameters = parameters
-        super(Action, self).__init__(act=self.act, parameters=self.parameters)
+            parameters = tuple(parameters)
+        _set_act(self, act)
+        _set_parameters(self, parameters)
+
+    def __setattr__(self, name, value):
+        raise TypeError("Action is immutable, use replace or with_parameter to build a new one")
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return Action, (self.act, list(self.parameters))
 
-    def add_parameter(self, type, value):
-        self.parameters.append((type, value))
+    def __eq__(self, other):
+        return isinstance(other, Action) and self.act == other.act and self.parameters == other.parameters
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Action(%s, %r)" % (ACT_NAMES.get(self.act, self.act), list(self.parameters))
+
+    def replace(self, act=None, parameters=None):
+        """
+        :param act: the new act code. None to keep the act
+        :param parameters: the new parameters. None to keep the parameters
+        :return: a new action with the given fields replaced
+        """
+        return Action(self.act if act is None else act,
+                      list(self.parameters) if parameters is None else parameters)
+
+    def with_parameter(self, type, value):
+        """
+        :return: a new action with the parameter (type, value) appended
+        """
+        return Action(self.act, list(self.parameters) + [(type, value)])
+
+    def to_dict(self):
+        """
+        :return: the action in the format of the corpus, with the act string instead of the act code
+        """
+        return {'act': ACT_NAMES[self.act], 'parameters': list(self.parameters)}
+
+    @staticmethod
+    def json_default(obj):
+        """
+        The default hook of json.dump(s) that writes the actions of the dialogs as dicts.
+        """
+        if isinstance(obj, Action):
+            return obj.to_dict()
+        raise TypeError("%r is not JSON serializable" % (obj,))
 
     def dump_string(self):
         str_paras = []
@@ -53,7 +107,12 @@ class Action(dict):
             else:
                 str_paras.append(p)
         str_paras = "-".join(str_paras)
-        return "%s:%s" % (self.act, str_paras)
+        return "%s:%s" % (ACT_NAMES.get(self.act, self.act), str_paras)
+
+
+# the slot descriptors write the fields of the immutable Action, bypassing its __setattr__
+_set_act = Action.act.__set__
+_set_parameters = Action.parameters.__set__
 
 
 class State(object):
@@ -109,12 +168,16 @@ class State(object):
         :param speaker: SYS or USR
         :param actions: a list of Action
         """
-        # make a deep copy of actions
-        self.history.append((speaker, copy.deepcopy(actions)))
+        # the actions are immutable, so the turn only needs its own list
+        self.history.append((speaker, list(actions)))
 
 
 class SystemAct(object):
     """
+    The acts are small integers, so the agents dispatch on them without hashing strings. They are
+    decoded into ACT_NAMES only in the generated corpus. The slots are not encoded yet and still move
+    between the agents as their names.
+
     :cvar IMPLICIT_CONFIRM: you said XX
     :cvar EXPLICIT_CONFIRM: do you mean XX
     :cvar INFORM: I think XX is a good fit
@@ -126,20 +189,22 @@ class SystemAct(object):
     :cvar ASK_REPEAT: what did you say?
     """
 
-    IMPLICIT_CONFIRM = "implicit_confirm"
-    EXPLICIT_CONFIRM = "explicit_confirm"
-    INFORM = "inform"
-    REQUEST = "request"
-    GREET = "greet"
-    GOODBYE = "goodbye"
-    CLARIFY = "clarify"
-    ASK_REPHRASE = "ask_rephrase"
-    ASK_REPEAT = "ask_repeat"
-    QUERY = "query"
+    IMPLICIT_CONFIRM = 0
+    EXPLICIT_CONFIRM = 1
+    INFORM = 2
+    REQUEST = 3
+    GREET = 4
+    GOODBYE = 5
+    CLARIFY = 6
+    ASK_REPHRASE = 7
+    ASK_REPEAT = 8
+    QUERY = 9
 
 
 class UserAct(object):
     """
+    The codes do not overlap with SystemAct.
+
     :cvar CONFIRM: yes
     :cvar DISCONFIRM: no
     :cvar YN_QUESTION: Is it going to rain?
@@ -150,18 +215,43 @@ class UserAct(object):
     :cvar GOODBYE: goodbye
     :cvar CHAT: how is your day
     """
-    GREET = "greet"
-    INFORM = "inform"
-    REQUEST = "request"
-    YN_QUESTION = "yn_question"
-    CONFIRM = "confirm"
-    DISCONFIRM = "disconfirm"
-    GOODBYE = "goodbye"
-    NEW_SEARCH = "new_search"
-    CHAT = "chat"
-    SATISFY = "satisfy"
-    MORE_REQUEST = "more_request"
-    KB_RETURN = "kb_return"
+    GREET = 100
+    INFORM = 101
+    REQUEST = 102
+    YN_QUESTION = 103
+    CONFIRM = 104
+    DISCONFIRM = 105
+    GOODBYE = 106
+    NEW_SEARCH = 107
+    CHAT = 108
+    SATISFY = 109
+    MORE_REQUEST = 110
+    KB_RETURN = 111
+
+
+# act code -> the act string in the generated corpus
+ACT_NAMES = {SystemAct.IMPLICIT_CONFIRM: "implicit_confirm",
+             SystemAct.EXPLICIT_CONFIRM: "explicit_confirm",
+             SystemAct.INFORM: "inform",
+             SystemAct.REQUEST: "request",
+             SystemAct.GREET: "greet",
+             SystemAct.GOODBYE: "goodbye",
+             SystemAct.CLARIFY: "clarify",
+             SystemAct.ASK_REPHRASE: "ask_rephrase",
+             SystemAct.ASK_REPEAT: "ask_repeat",
+             SystemAct.QUERY: "query",
+             UserAct.GREET: "greet",
+             UserAct.INFORM: "inform",
+             UserAct.REQUEST: "request",
+             UserAct.YN_QUESTION: "yn_question",
+             UserAct.CONFIRM: "confirm",
+             UserAct.DISCONFIRM: "disconfirm",
+             UserAct.GOODBYE: "goodbye",
+             UserAct.NEW_SEARCH: "new_search",
+             UserAct.CHAT: "chat",
+             UserAct.SATISFY: "satisfy",
+             UserAct.MORE_REQUEST: "more_request",
+             UserAct.KB_RETURN: "kb_return"}
 
 
 class BaseSysSlot(object):
@@ -6,7 +6,6 @@ import numpy as np
 from simdial.agent.core import SystemAct, UserAct, BaseUsrSlot
 from simdial.agent import core
 import json
-import copy
 
 
 class AbstractNlg(object):
@@ -14,9 +13,10 @@ class AbstractNlg(object):
     Abstract class of NLG
     """
 
-    def __init__(self, domain, complexity):
+    def __init__(self, domain, complexity, rng=None):
         self.domain = domain
         self.complexity = complexity
+        self.rng = np.random if rng is None else rng
 
     def generate_sent(self, actions, **kwargs):
         """
@@ -28,7 +28,7 @@ class AbstractNlg(object):
         raise NotImplementedError("Generate sent is required for NLG")
 
     def sample(self, examples):
-        return np.random.choice(examples)
+        return self.rng.choice(examples)
 
 
 class SysCommonNlg(object):
@@ -37,15 +37,15 @@ class SysCommonNlg(object):
                  SystemAct.ASK_REPHRASE: ["Can you please rephrase that?", "Can you say it in another way?"],
                  SystemAct.GOODBYE: ["Goodbye.", "See you next time."],
                  SystemAct.CLARIFY: ["I didn't catch you."],
-                 SystemAct.REQUEST+core.BaseUsrSlot.NEED: ["What can I do for you?",
+                 (SystemAct.REQUEST, core.BaseUsrSlot.NEED): ["What can I do for you?",
                                                            "What do you need?",
                                                            "How can I help?"],
-                 SystemAct.REQUEST+core.BaseUsrSlot.HAPPY: ["What else can I do?",
+                 (SystemAct.REQUEST, core.BaseUsrSlot.HAPPY): ["What else can I do?",
                                                             "Are you happy about my answer?",
                                                             "Anything else?"],
-                 SystemAct.EXPLICIT_CONFIRM+"dont_care": ["Okay, you dont_care, do you?",
+                 (SystemAct.EXPLICIT_CONFIRM, "dont_care"): ["Okay, you dont_care, do you?",
                                                           "You dont_care, right?"],
-                 SystemAct.IMPLICIT_CONFIRM+"dont_care": ["Okay, you dont_care.",
+                 (SystemAct.IMPLICIT_CONFIRM, "dont_care"): ["Okay, you dont_care.",
                                                           "Alright, dont_care."]}
 
 class SysNlg(AbstractNlg):
@@ -64,7 +64,8 @@ class SysNlg(AbstractNlg):
         str_actions = []
         lexicalized_actions = []
         for a in actions:
-            a_copy = copy.deepcopy(a)
+            # the lexicalized action is a new one if it differs from a
+            lexicalized = a
             if a.act == SystemAct.GREET:
                 if domain:
                     str_actions.append(domain.greet)
@@ -84,8 +85,7 @@ class SysNlg(AbstractNlg):
                     else:
                         search_dict[k] = slot.vocabulary[v]
 
-                a_copy.parameters[0] = search_dict
-                a_copy.parameters[1] = sys_goals
+                lexicalized = a.replace(parameters=[search_dict, sys_goals] + list(a.parameters[2:]))
                 str_actions.append(json.dumps({"QUERY": search_dict,
                                                "GOALS": sys_goals}))
 
@@ -103,50 +103,52 @@ class SysNlg(AbstractNlg):
                         prefix = "Yes, " if v == e_v else "No, "
                     else:
                         prefix = ""
-                    informs.append(prefix + slot.sample_inform()
+                    informs.append(prefix + slot.sample_inform(self.rng)
                                    % slot.vocabulary[v])
-                a_copy['parameters'] = [sys_goal_dict]
+                lexicalized = a.replace(parameters=[sys_goal_dict])
                 str_actions.append(" ".join(informs))
 
             elif a.act == SystemAct.REQUEST:
                 slot_type, _ = a.parameters[0]
                 if slot_type in [core.BaseUsrSlot.NEED, core.BaseUsrSlot.HAPPY]:
-                    str_actions.append(self.sample(templates[SystemAct.REQUEST+slot_type]))
+                    str_actions.append(self.sample(templates[(SystemAct.REQUEST, slot_type)]))
                 else:
                     target_slot = self.domain.get_usr_slot(slot_type)
                     if target_slot is None:
                         raise ValueError("none slot %s" % slot_type)
-                    str_actions.append(target_slot.sample_request())
+                    str_actions.append(target_slot.sample_request(self.rng))
 
             elif a.act == SystemAct.EXPLICIT_CONFIRM:
                 slot_type, slot_val = a.parameters[0]
                 if slot_val is None:
-                    str_actions.append(self.sample(templates[SystemAct.EXPLICIT_CONFIRM+"dont_care"]))
-                    a_copy.parameters[0] = (slot_type, "dont_care")
+                    str_actions.append(self.sample(templates[(SystemAct.EXPLICIT_CONFIRM, "dont_care")]))
+                    lexicalized = a.replace(parameters=[(slot_type, "dont_care")] + list(a.parameters[1:]))
                 else:
                     slot = self.domain.get_usr_slot(slot_type)
                     str_actions.append("Do you mean %s?"
                                        % slot.vocabulary[slot_val])
-                    a_copy.parameters[0] = (slot_type, slot.vocabulary[slot_val])
+                    lexicalized = a.replace(parameters=[(slot_type, slot.vocabulary[slot_val])]
+                                            + list(a.parameters[1:]))
 
             elif a.act == SystemAct.IMPLICIT_CONFIRM:
                 slot_type, slot_val = a.parameters[0]
                 if slot_val is None:
-                    str_actions.append(self.sample(templates[SystemAct.IMPLICIT_CONFIRM+"dont_care"]))
-                    a_copy.parameters[0] = (slot_type, "dont_care")
+                    str_actions.append(self.sample(templates[(SystemAct.IMPLICIT_CONFIRM, "dont_care")]))
+                    lexicalized = a.replace(parameters=[(slot_type, "dont_care")] + list(a.parameters[1:]))
                 else:
                     slot = self.domain.get_usr_slot(slot_type)
                     str_actions.append("I believe you said %s."
                                        % slot.vocabulary[slot_val])
-                    a_copy.parameters[0] = (slot_type, slot.vocabulary[slot_val])
+                    lexicalized = a.replace(parameters=[(slot_type, slot.vocabulary[slot_val])]
+                                            + list(a.parameters[1:]))
 
             elif a.act in templates.keys():
                 str_actions.append(self.sample(templates[a.act]))
 
             else:
-                raise ValueError("Unknown dialog act %s" % a.act)
+                raise ValueError("Unknown dialog act %s" % core.ACT_NAMES.get(a.act, a.act))
 
-            lexicalized_actions.append(a_copy)
+            lexicalized_actions.append(lexicalized)
 
         return " ".join(str_actions), lexicalized_actions
 
@@ -182,7 +184,7 @@ class UserNlg(AbstractNlg):
             elif a.act == UserAct.REQUEST:
                 slot_type, _ = a.parameters[0]
                 target_slot = self.domain.get_sys_slot(slot_type)
-                str_actions.append(target_slot.sample_request())
+                str_actions.append(target_slot.sample_request(self.rng))
 
             elif a.act == UserAct.INFORM:
                 has_self_correct = a.parameters[-1][0] == BaseUsrSlot.SELF_CORRECT
@@ -193,10 +195,10 @@ class UserNlg(AbstractNlg):
                     if val is None:
                         return self.sample(["Anything is fine.", "I don't care.", "Whatever is good."])
                     else:
-                        return target_slot.sample_inform() % target_slot.vocabulary[val]
+                        return target_slot.sample_inform(self.rng) % target_slot.vocabulary[val]
 
                 if has_self_correct:
-                    wrong_value = target_slot.sample_different(slot_value)
+                    wrong_value = target_slot.sample_different(slot_value, self.rng)
                     wrong_utt = get_inform_utt(wrong_value)
                     correct_utt = get_inform_utt(slot_value)
                     connector = self.sample(["Oh no,", "Uhm sorry,", "Oh sorry,"])
@@ -211,7 +213,7 @@ class UserNlg(AbstractNlg):
                 slot_type, expect_id = a.parameters[0]
                 target_slot = self.domain.get_sys_slot(slot_type)
                 expect_val = target_slot.vocabulary[expect_id]
-                str_actions.append(target_slot.sample_yn_question(expect_val))
+                str_actions.append(target_slot.sample_yn_question(expect_val, self.rng))
 
             elif a.act == UserAct.CONFIRM:
                 str_actions.append(self.sample(["Yes.", "Yep.", "Yeah.", "That's correct.", "Uh-huh."]))
@@ -229,7 +231,7 @@ class UserNlg(AbstractNlg):
                 str_actions.append(self.sample(["I want to search a new one.", "New request.", "A new search."]))
 
             else:
-                raise ValueError("Unknown user act %s for NLG" % a.act)
+                raise ValueError("Unknown user act %s for NLG" % core.ACT_NAMES.get(a.act, a.act))
 
         return " ".join(str_actions)
 
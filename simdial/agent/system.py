@@ -10,9 +10,10 @@ import copy
 
 class BeliefSlot(object):
     """
-    A slot with a probabilistic distribution over the possible values
-    
-    :ivar value_map: entity_value -> (score, norm_value)
+    A slot with a probabilistic distribution over the possible values. The confidences are kept in a dense
+    row indexed by value: position 0 is None (don't care) and position v+1 is the value id v.
+
+    :ivar conf: 1D array [dim+1] of the confidence of every value. -inf if the value was never observed.
     :ivar last_update_turn: the last turn ID this slot is modified
     :ivar uid: the unique ID, i.e. slot name
     """
@@ -21,69 +22,121 @@ class BeliefSlot(object):
     IMPLICIT_THRESHOLD = 0.6
     GROUND_THRESHOLD = 0.95
 
-    def __init__(self, uid, vocabulary):
+    def __init__(self, uid, vocabulary, conf=None):
+        """
+        :param conf: an optional row of a larger array to keep the confidences in, see DialogState
+        """
         self.uid = uid
-        self.value_map = {}
+        if conf is None:
+            conf = np.full(len(vocabulary)+1, -np.inf)
+        self.conf = conf
+        # the position of the max confidence, -1 if empty and None if it needs to be recomputed
+        self._max_idx = -1
         self.last_update_turn = -1
         self.logger = logging.getLogger(__name__)
 
+    @staticmethod
+    def _index(value):
+        return 0 if value is None else value + 1
+
+    def _argmax(self):
+        if self._max_idx is None:
+            conf = self.conf
+            # the last max, so ties go to the larger value and None loses them, as with max over (conf, value)
+            idx = len(conf) - 1 - int(conf[::-1].argmax())
+            self._max_idx = idx if conf[idx] > -np.inf else -1
+        return self._max_idx
+
     def add_new_observation(self, value, conf, turn_id):
         self.last_update_turn = turn_id
+        idx = self._index(value)
 
-        if value in self.value_map.keys():
-            prev_conf = self.value_map[value]
-            self.value_map[value] = max([prev_conf, conf]) + 0.2
+        if self.conf[idx] > -np.inf:
+            prev_conf = self.conf[idx]
+            self.conf[idx] = max([prev_conf, conf]) + 0.2
             self.logger.info("Update %s conf to %f at turn %d" % (value, conf, turn_id))
         else:
-            self.value_map = {k: c/2 for k, c in self.value_map.items()}
-            self.value_map[value] = conf
+            self.conf /= 2
+            self.conf[idx] = conf
             self.logger.info("Add %s conf as %f at turn %d" % (value, conf, turn_id))
+        self._max_idx = None
 
     def add_grounding(self, confirm_conf, disconfirm_conf, turn_id, target_value=None):
-        if len(self.value_map) > 0:
+        if self._argmax() >= 0:
             self.last_update_turn = turn_id
             if target_value is None:
                 grounded_value = self.get_maxconf_value()
             else:
                 grounded_value = target_value
+            idx = self._index(grounded_value)
             up_conf = confirm_conf * (1.0 - self.EXPLICIT_THRESHOLD)
             down_conf = disconfirm_conf * (1.0 - self.EXPLICIT_THRESHOLD)
-            old_conf = self.value_map[grounded_value]
+            old_conf = self.conf[idx]
             new_conf = max(0.0, min((old_conf + up_conf - down_conf), 1.5))
-            self.value_map[grounded_value] = new_conf
+            self.conf[idx] = new_conf
+            self._max_idx = None
             self.logger.info(
                 "Ground %s from %f to %f at turn %d" % (grounded_value, old_conf, new_conf, turn_id))
         else:
             self.logger.warn("Warn an concept without value")
 
     def get_maxconf_value(self):
-        if len(self.value_map) == 0:
+        idx = self._argmax()
+        if idx <= 0:
             return None
-        max_s, max_v = max([(s, v) for v, s in self.value_map.items()])
-        return max_v
+        return idx - 1
 
     def max_conf(self):
         """
         :return: the highest confidence of all potential values. 0.0 if its empty 
         """
-        if len(self.value_map) == 0:
+        idx = self._argmax()
+        if idx < 0:
             return 0.0
-        return max([s for s in self.value_map.values()])
+        return float(self.conf[idx])
 
     def clear(self, turn_id):
         middle = (self.IMPLICIT_THRESHOLD+self.EXPLICIT_THRESHOLD)/2.
-        self.value_map = {k: middle for k in self.value_map.keys()}
+        self.conf[self.conf > -np.inf] = middle
+        self._max_idx = None
 
 
 class BeliefGoal(object):
+    """
+    A system goal. Its confidence and delivered flag live in the arrays of the DialogState.
+
+    :ivar value: the value id returned by the KB, None if unknown
+    :ivar expected_value: the value id of a yes/no question of the user, None if not asked
+    """
+
     THRESHOLD = 0.7
 
-    def __init__(self, uid, conf=0.0):
+    def __init__(self, uid, conf=0.0, confs=None, delivered=None, idx=0):
+        """
+        :param confs: an optional array of goal confidences to keep the confidence in at idx
+        :param delivered: an optional bool array of delivered flags to keep the flag in at idx
+        """
         self.uid = uid
-        self.conf = conf
-        self.delivered = False
-        self.value = None
-        self.expected_value = None
+        self._confs = np.zeros(1) if confs is None else confs
+        self._delivered = np.zeros(1, dtype=bool) if delivered is None else delivered
+        self._idx = 0 if confs is None else idx
+        self.reset(conf)
+
+    @property
+    def conf(self):
+        return float(self._confs[self._idx])
+
+    @conf.setter
+    def conf(self, conf):
+        self._confs[self._idx] = conf
+
+    @property
+    def delivered(self):
+        return bool(self._delivered[self._idx])
+
+    @delivered.setter
+    def delivered(self, delivered):
+        self._delivered[self._idx] = delivered
 
     def add_observation(self, conf, expected_value):
         self.conf = max(conf, self.conf) + 0.2
@@ -100,6 +153,11 @@ class BeliefGoal(object):
         self.delivered = False
         self.expected_value = None
 
+    def reset(self, conf=0.0):
+        self.clear()
+        self.conf = conf
+        self.value = None
+
 
 class DialogState(State):
     """
@@ -107,9 +165,16 @@ class DialogState(State):
 
     :ivar history: the raw dialog history
     :ivar spk_state: the FSM state for turn-taking. SPK, LISTEN or EXIT
-    :ivar valid_entries: a list of valid system entries satisfy the user belief
+    :ivar valid_entries: the read-only system entries that satisfy the max values of the user beliefs. They
+    are only selected when read, by narrowing the entries of the previous read when possible.
     :ivar usr_beliefs: a dict of slot name -> BeliefSlot()
     :ivar sys_goals:  a dict of system goal that is obligated to answer
+    :ivar usr_conf: 2D array [num_usr_slots, max_dim+1] of the confidences of the usr_beliefs, one row per
+    slot padded with -inf. The arrays have the same shape for every dialog of a domain, so the states of
+    many dialogs can be stacked.
+    :ivar goal_conf: 1D array [num_sys_slots] of the confidences of the sys_goals
+    :ivar goal_delivered: 1D bool array [num_sys_slots] of the delivered flags of the sys_goals
+    :ivar goal_list: the BeliefGoal of sys_goals in the order of the arrays
     """
     INFORM_THRESHOLD = 5
 
@@ -117,10 +182,22 @@ class DialogState(State):
         super(State, self).__init__()
         self.history = []
         self.spk_state = self.SPEAK
-        self.usr_beliefs = OrderedDict([(s.name, BeliefSlot(s.name, s.vocabulary)) for s in domain.usr_slots])
-        self.sys_goals = OrderedDict([(s.name, BeliefGoal(s.name)) for s in domain.sys_slots])
-        self.sys_goals[BaseSysSlot.DEFAULT] = BeliefGoal(BaseSysSlot.DEFAULT, conf=1.0)
-        self.valid_entries = domain.db.select(self.gen_query())
+        max_dim = max([len(s.vocabulary) for s in domain.usr_slots])
+        self.usr_conf = np.full((len(domain.usr_slots), max_dim+1), -np.inf)
+        self.usr_beliefs = OrderedDict([(s.name, BeliefSlot(s.name, s.vocabulary,
+                                                            conf=self.usr_conf[i, 0:len(s.vocabulary)+1]))
+                                        for i, s in enumerate(domain.usr_slots)])
+        self.goal_conf = np.zeros(len(domain.sys_slots))
+        self.goal_delivered = np.zeros(len(domain.sys_slots), dtype=bool)
+        self.sys_goals = OrderedDict([(s.name, BeliefGoal(s.name, confs=self.goal_conf,
+                                                          delivered=self.goal_delivered, idx=i))
+                                      for i, s in enumerate(domain.sys_slots)])
+        self.sys_goals[BaseSysSlot.DEFAULT].reset(conf=1.0)
+        self.goal_list = list(self.sys_goals.values())
+        # the query of the last read of valid_entries and its entries and row ids
+        self._valid_query = None
+        self._valid_entries = None
+        self._valid_idx = None
         self.pending_return = None
         self.domain = domain
 
@@ -137,23 +214,61 @@ class DialogState(State):
             query.append(max_val)
         return query
 
+    @property
+    def valid_entries(self):
+        query = self.gen_query()
+        if query != self._valid_query:
+            old_query = self._valid_query
+            if old_query is not None and all([o is None or o == q for o, q in zip(old_query, query)]):
+                # only new constrains, so the previous entries are a superset of the new ones
+                valid_idx = self._valid_idx
+                constrains = [(a_id, q) for a_id, (o, q) in enumerate(zip(old_query, query))
+                              if o is None and q is not None]
+            else:
+                valid_idx = None
+                constrains = [(a_id, q) for a_id, q in enumerate(query) if q is not None]
+            self._valid_entries, self._valid_idx = self.domain.db.refine(query, valid_idx, constrains)
+            self._valid_query = query
+        return self._valid_entries
+
+    def num_valid_entries(self):
+        """
+        :return: the number of valid_entries, counted without selecting them if they are not up to date
+        """
+        query = self.gen_query()
+        if query == self._valid_query:
+            return len(self._valid_entries)
+        return self.domain.db.count(query)
+
     def has_pending_return(self):
         return self.pending_return is not None
 
     def ready_to_inform(self):
-        # if len(self.valid_entries) <= self.INFORM_THRESHOLD:
+        # if self.num_valid_entries() <= self.INFORM_THRESHOLD:
         #    return True
 
-        for slot in self.usr_beliefs.values():
-            if slot.max_conf() < slot.GROUND_THRESHOLD:
-                return False
+        # the -inf of the empty slots and of the padding are below the threshold as well
+        if np.minimum.reduce(np.maximum.reduce(self.usr_conf, axis=1)) < BeliefSlot.GROUND_THRESHOLD:
+            return False
 
-        for goal in self.sys_goals.values():
-            if BeliefGoal.THRESHOLD > goal.get_conf() > 0:
-                return False
+        if self.has_unsure_goal():
+            return False
 
         return True
 
+    def has_unsure_goal(self):
+        """
+        :return: True if a system goal was mentioned but its confidence is below BeliefGoal.THRESHOLD
+        """
+        return bool(np.logical_or.reduce((self.goal_conf > 0) & (self.goal_conf < BeliefGoal.THRESHOLD)))
+
+    def pending_goals(self):
+        """
+        :return: the system goals that are confident enough and not delivered yet, in the sys_goals order
+        """
+        pending = ((self.goal_conf >= BeliefGoal.THRESHOLD) & ~self.goal_delivered).nonzero()[0]
+        return [self.goal_list[i] for i in pending.tolist()]
+
     def yield_floor(self, actions):
         if type(actions) is list:
             last_action = actions[-1]
@@ -167,7 +282,7 @@ class DialogState(State):
     def reset_sys_goals(self):
         for goal in self.sys_goals.values():
             goal.clear()
-        self.sys_goals[BaseSysSlot.DEFAULT] = BeliefGoal(BaseSysSlot.DEFAULT, conf=1.0)
+        self.sys_goals[BaseSysSlot.DEFAULT].reset(conf=1.0)
 
     def reset_slots(self):
         for slot in self.usr_beliefs.values():
@@ -185,7 +300,7 @@ class DialogState(State):
             usr_slots.append({'name':slot.uid, 'max_conf': max_conf, 'max_val': max_val})
 
         sys_goals = []
-        for goal in self.sys_goals.values():
+        for goal, conf, delivered in zip(self.goal_list, self.goal_conf.tolist(), self.goal_delivered.tolist()):
             value = goal.value
             exp_value = goal.expected_value
             if value is not None:
@@ -196,9 +311,9 @@ class DialogState(State):
                 sys_goal = self.domain.get_sys_slot(goal.uid)
                 exp_value = sys_goal.vocabulary[exp_value]
 
-            sys_goals.append({'name': goal.uid, 'delivered': goal.delivered,
+            sys_goals.append({'name': goal.uid, 'delivered': delivered,
                               'value': value, 'expected': exp_value,
-                              'conf': goal.conf})
+                              'conf': conf})
 
         return {'usr_slots': usr_slots, 'sys_goals': sys_goals,
                 'kb_update': self.has_pending_return()}
@@ -207,12 +322,15 @@ class DialogState(State):
 class System(Agent):
     """
     basic system agent
+
+    :ivar track_state: if False, step does not summarize the dialog state and returns None as state
     """
     logger = logging.getLogger(__name__)
 
-    def __init__(self, domain, complexity):
-        super(System, self).__init__(domain, complexity)
+    def __init__(self, domain, complexity, rng=None, track_state=True):
+        super(System, self).__init__(domain, complexity, rng)
         self.state = DialogState(domain)
+        self.track_state = track_state
 
     def state_update(self, usr_actions, conf):
         """
@@ -292,9 +410,8 @@ class System(Agent):
             # system goal
             query = self.state.pending_return
             goals = {}
-            for goal in self.state.sys_goals.values():
-                if goal.delivered is False and goal.conf >= BeliefGoal.THRESHOLD:
-                    goals[goal.uid] = (goal.value, goal.expected_value)
+            for goal in self.state.pending_goals():
+                goals[goal.uid] = (goal.value, goal.expected_value)
 
             actions.append(Action(SystemAct.INFORM, [dict(query), goals]))
             actions.append(Action(SystemAct.REQUEST, (BaseUsrSlot.HAPPY, None)))
@@ -308,10 +425,7 @@ class System(Agent):
             # user constrains
             query = [(key, slot.get_maxconf_value()) for key, slot in self.state.usr_beliefs.items()]
             # system goal
-            goals = []
-            for goal in self.state.sys_goals.values():
-                if goal.delivered is False and goal.conf >= BeliefGoal.THRESHOLD:
-                    goals.append(goal.uid)
+            goals = [goal.uid for goal in self.state.pending_goals()]
             if len(goals) == 0:
                 raise ValueError("Empty goal. Debug!")
             actions.append(Action(SystemAct.QUERY, [query, goals]))
@@ -328,10 +442,8 @@ class System(Agent):
                 elif slot.max_conf() < slot.GROUND_THRESHOLD:
                     implicit_confirms.append(Action(SystemAct.IMPLICIT_CONFIRM, (slot.uid, slot.get_maxconf_value())))
 
-            for goal in self.state.sys_goals.values():
-                if BeliefGoal.THRESHOLD > goal.get_conf() > 0:
-                    requests.append(Action(SystemAct.REQUEST, (BaseUsrSlot.NEED, None)))
-                    break
+            if self.state.has_unsure_goal():
+                requests.append(Action(SystemAct.REQUEST, (BaseUsrSlot.NEED, None)))
 
             if len(exp_confirms) > 0:
                 actions.extend(implicit_confirms + exp_confirms[0:1])
@@ -348,12 +460,12 @@ class System(Agent):
 
         :param inputs: a list of Action
         :param conf: the probability that this user input is correct
-        :return: reward, terminal, [Action], state
+        :return: reward, terminal, [Action], state. state is None if track_state is False
         """
         turn_actions = []
         # update the dialog state
         self.state_update(inputs, conf)
-        state = self.state.state_summary()
+        state = self.state.state_summary() if self.track_state else None
         while True:
             action = self.policy()
 
@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
-from simdial.agent.core import Agent, Action, UserAct, SystemAct, BaseSysSlot, BaseUsrSlot, State
+from simdial.agent.core import Agent, Action, UserAct, SystemAct, BaseSysSlot, BaseUsrSlot, State, ACT_NAMES
 import logging
-import numpy as np
-import copy
+import itertools
 from collections import OrderedDict
 
 
@@ -71,9 +70,9 @@ class User(Agent):
         def reset_goal(self, sys_goals):
             self.goals_met = {g: False for g in sys_goals}
 
-    def __init__(self, domain, complexity):
-        super(User, self).__init__(domain, complexity)
-        self.goal_cnt = np.random.choice(complexity.multi_goals.keys(), p=complexity.multi_goals.values())
+    def __init__(self, domain, complexity, rng=None):
+        super(User, self).__init__(domain, complexity, rng)
+        self.goal_cnt = self.rng.choice(complexity.multi_goals.keys(), p=complexity.multi_goals.values())
         self.goal_ptr = 0
         self.usr_constrains, self.sys_goals = self._sample_goal()
         self.state = self.DialogState(self.sys_goals)
@@ -86,35 +85,62 @@ class User(Agent):
         """
         self.state.update_history(self.state.SYS, sys_actions)
         self.state.spk_state = self.DialogState.SPEAK
-        self.state.input_buffer = copy.deepcopy(sys_actions)
+        self.state.input_buffer = list(sys_actions)
 
     def _sample_goal(self):
         """
         :return: {slot_name -> value} for user constrains, [slot_name, ..] for system goals
         """
-        temp_constrains = self.domain.db.sample_unique_row().tolist()
-        temp_constrains = [None if np.random.rand() < self.complexity.dont_care
+        temp_constrains = self.domain.db.sample_unique_row(self.rng).tolist()
+        temp_constrains = [None if self.rng.rand() < self.complexity.dont_care
                            else c for c in temp_constrains]
         # there is a chance user does not care
         usr_constrains = {s.name: temp_constrains[i] for i, s in enumerate(self.domain.usr_slots)}
 
         # sample the number of attribute about the system
-        num_interest = np.random.randint(0, len(self.domain.sys_slots)-1)
+        num_interest = self.rng.randint(0, len(self.domain.sys_slots)-1)
         goal_candidates = [s.name for s in self.domain.sys_slots if s.name != BaseSysSlot.DEFAULT]
-        selected_goals = np.random.choice(goal_candidates, size=num_interest, replace=False)
-        np.random.shuffle(selected_goals)
+        selected_goals = self.rng.choice(goal_candidates, size=num_interest, replace=False)
+        self.rng.shuffle(selected_goals)
         sys_goals = [BaseSysSlot.DEFAULT] + selected_goals.tolist()
         return usr_constrains, sys_goals
 
     def _constrain_equal(self, top_action):
+        """
+        :return: True/False if the proposed constrains are the user constrains, and the slots to inform again.
+        A wrong value is corrected first. The constrains that the query left open, e.g. because it had to
+        drop them to match any entry, are informed again together once the other ones are right.
+        """
         proposed_constrains = top_action.parameters[0]
+        open_slots = []
         for k, v in self.usr_constrains.items():
             if k in proposed_constrains:
-                if v != proposed_constrains[k]:
-                    return False, k
+                if proposed_constrains[k] is None and v is not None:
+                    open_slots.append(k)
+                elif v != proposed_constrains[k]:
+                    return False, [k]
             else:
-                return False, k
-        return True, None
+                return False, [k]
+        if open_slots:
+            return False, open_slots
+        return True, []
+
+    def _relax_query(self, db_query):
+        """
+        A misheard value can make the system ask for a combination that is not in the database. Leave open
+        as few constrains as possible, the last ones first, so that some entries match. The relaxed query is
+        returned with the results, so the user sees which constrains were dropped and informs them again.
+
+        :param db_query: the values of a query that matches no entry, None means don't care
+        :return: the relaxed db_query
+        """
+        constrained = [i for i, v in reversed(list(enumerate(db_query))) if v is not None]
+        for num_open in range(1, len(constrained)+1):
+            for open_slots in itertools.combinations(constrained, num_open):
+                relaxed = [None if i in open_slots else v for i, v in enumerate(db_query)]
+                if self.domain.db.count(relaxed) > 0:
+                    return relaxed
+        raise ValueError("The database is empty")
 
     def _increment_goal(self):
         if self.goal_ptr >= self.goal_cnt-1:
@@ -122,12 +148,21 @@ class User(Agent):
         else:
             self.goal_ptr += 1
             _, self.sys_goals = self._sample_goal()
-            change_key = np.random.choice(self.usr_constrains.keys())
-            change_slot = self.domain.get_usr_slot(change_key)
+            change_key = self.rng.choice(self.usr_constrains.keys())
+            change_slot, change_idx = self.domain.get_usr_slot(change_key, return_idx=True)
             old_value = self.usr_constrains[change_key]
-            old_value = -1 if old_value is None else old_value
-            new_value = np.random.randint(0, change_slot.dim-1) % change_slot.dim
-            self.logger.info("Filp user constrain %s from %d to %d" %
+
+            # only change to a value that some entries have together with the other constrains,
+            # otherwise the next query cannot match anything. Don't care if there is no such value.
+            query = [self.usr_constrains[s.name] for s in self.domain.usr_slots]
+            candidates = []
+            for value in range(change_slot.dim):
+                query[change_idx] = value
+                if value != old_value and self.domain.db.count(query) > 0:
+                    candidates.append(value)
+            new_value = candidates[self.rng.randint(0, len(candidates))] if candidates else None
+
+            self.logger.info("Filp user constrain %s from %s to %s" %
                              (change_key, old_value, new_value))
             self.usr_constrains[change_key] = new_value
             self.state.reset_goal(self.sys_goals)
@@ -158,12 +193,12 @@ class User(Agent):
             if len(top_action.parameters) == 0:
                 raise ValueError("IMPLICIT_CONFIRM is required to have parameter")
             slot_type, slot_val = top_action.parameters[0]
-            if self.domain.is_usr_slot(slot_type):
+            if slot_type in self.domain.usr_slot_names:
                 # if the confirm is right or usr does not care about this slot
                 if slot_val == self.usr_constrains[slot_type] or self.usr_constrains[slot_type] is None:
                     return None
                 else:
-                    strategy = np.random.choice(self.complexity.reject_style.keys(),
+                    strategy = self.rng.choice(self.complexity.reject_style.keys(),
                                                 p=self.complexity.reject_style.values())
                     if strategy == "reject":
                         return Action(UserAct.DISCONFIRM, (slot_type, slot_val))
@@ -179,7 +214,7 @@ class User(Agent):
             if len(top_action.parameters) == 0:
                 raise ValueError("EXPLICIT_CONFIRM is required to have parameter")
             slot_type, slot_val = top_action.parameters[0]
-            if self.domain.is_usr_slot(slot_type):
+            if slot_type in self.domain.usr_slot_names:
                 # if the confirm is right or usr does not care about this slot
                 if slot_val == self.usr_constrains[slot_type]:
                     return Action(UserAct.CONFIRM, (slot_type, slot_val))
@@ -193,7 +228,7 @@ class User(Agent):
                 raise ValueError("INFORM needs to contain the constrains and goal (2 parameters)")
 
             # check if the constrains are the same
-            valid_constrain, wrong_slot = self._constrain_equal(top_action)
+            valid_constrain, wrong_slots = self._constrain_equal(top_action)
             if valid_constrain:
                 # update the state for goal met
                 complete_goals = self.state.update_goals_met(top_action)
@@ -209,10 +244,10 @@ class User(Agent):
                                 Action(UserAct.GOODBYE)]
                 else:
                     ack_act = Action(UserAct.MORE_REQUEST, [(g, None) for g in complete_goals])
-                    if np.random.rand() < self.complexity.yn_question:
+                    if self.rng.rand() < self.complexity.yn_question:
                         # find a system slot with yn_templates
                         slot = self.domain.get_sys_slot(next_goal)
-                        expected_val = np.random.randint(0, slot.dim)
+                        expected_val = self.rng.randint(0, slot.dim)
                         if len(slot.yn_questions.get(slot.vocabulary[expected_val], [])) > 0:
                             # sample a expected value
                             return [ack_act, Action(UserAct.YN_QUESTION, (slot.name, expected_val))]
@@ -220,7 +255,7 @@ class User(Agent):
                     return [ack_act, Action(UserAct.REQUEST, (next_goal, None))]
             else:
                 # find the wrong concept
-                return Action(UserAct.INFORM, (wrong_slot, self.usr_constrains[wrong_slot]))
+                return [Action(UserAct.INFORM, (k, self.usr_constrains[k])) for k in wrong_slots]
 
         elif top_action.act == SystemAct.REQUEST:
             if len(top_action.parameters) == 0:
@@ -235,16 +270,16 @@ class User(Agent):
             elif slot_type == BaseUsrSlot.HAPPY:
                 return None
 
-            elif self.domain.is_usr_slot(slot_type):
+            elif slot_type in self.domain.usr_slot_names:
                 if len(self.domain.usr_slots) > 1:
-                    num_informs = np.random.choice(self.complexity.multi_slots.keys(),
+                    num_informs = self.rng.choice(self.complexity.multi_slots.keys(),
                                                    p=self.complexity.multi_slots.values(),
                                                    replace=False)
                     if num_informs > 1:
                         candidates = [k for k, v in self.usr_constrains.items() if k != slot_type and v is not None]
                         num_extra = min(num_informs-1, len(candidates))
                         if num_extra > 0:
-                            extra_keys = np.random.choice(candidates, size=num_extra, replace=False)
+                            extra_keys = self.rng.choice(candidates, size=num_extra, replace=False)
                             actions = [Action(UserAct.INFORM, (key, self.usr_constrains[key])) for key in extra_keys]
                             actions.insert(0, Action(UserAct.INFORM, (slot_type, self.usr_constrains[slot_type])))
                             return actions
@@ -267,27 +302,27 @@ class User(Agent):
             last_usr_actions = self.state.last_actions(self.state.USR)
             if last_usr_actions is None:
                 raise ValueError("Unexpected ask rephrase")
-            for a in last_usr_actions:
-                a.add_parameter(BaseUsrSlot.AGAIN, True)
-            return last_usr_actions
+            return [a.with_parameter(BaseUsrSlot.AGAIN, True) for a in last_usr_actions]
 
         elif top_action.act == SystemAct.QUERY:
             query, goals = top_action.parameters[0], top_action.parameters[1]
             valid_entries = self.domain.db.select([v for name, v in query])
-            chosen_entry = valid_entries[np.random.randint(0, len(valid_entries)), :]
+            if len(valid_entries) == 0:
+                # return the relaxed query together with the results that were selected with it
+                db_query = self._relax_query([v for name, v in query])
+                query = [(name, v) for (name, _), v in zip(query, db_query)]
+                valid_entries = self.domain.db.select(db_query)
+            # tolist turns the compact numpy integers of the table into python ints
+            chosen_entry = valid_entries[self.rng.randint(0, len(valid_entries)), :].tolist()
 
             results = {}
-            if chosen_entry.shape[0] > 0:
-                for goal in goals:
-                    _, slot_id = self.domain.get_sys_slot(goal, return_idx=True)
-                    results[goal] = chosen_entry[slot_id]
-            else:
-                print(chosen_entry)
-                raise ValueError("No valid entries")
+            for goal in goals:
+                _, slot_id = self.domain.get_sys_slot(goal, return_idx=True)
+                results[goal] = chosen_entry[slot_id]
 
             return Action(UserAct.KB_RETURN, [query, results])
         else:
-            raise ValueError("Unknown system act %s" % top_action.act)
+            raise ValueError("Unknown system act %s" % ACT_NAMES.get(top_action.act, top_action.act))
 
     def step(self, inputs):
         """
@@ -2,13 +2,13 @@
 # author: Tiancheng Zhao
 import numpy as np
 from simdial.agent.core import UserAct, BaseUsrSlot
-import copy
 
 
 class AbstractNoise(object):
-    def __init__(self, domain, complexity):
+    def __init__(self, domain, complexity, rng=None):
         self.complexity = complexity
         self.domain = domain
+        self.rng = np.random if rng is None else rng
 
     def transmit(self, actions):
         raise NotImplementedError
@@ -18,12 +18,12 @@ class AbstractNoise(object):
 
 
 class EnvironmentNoise(AbstractNoise):
-    def __init__(self, domain, complexity):
-        super(EnvironmentNoise, self).__init__(domain, complexity)
+    def __init__(self, domain, complexity, rng=None):
+        super(EnvironmentNoise, self).__init__(domain, complexity, rng)
         self.dim_map = {slot.name: slot.dim for slot in domain.usr_slots}
 
     def transmit(self, actions):
-        conf = np.random.normal(self.complexity.asr_acc, self.complexity.asr_std)
+        conf = self.rng.normal(self.complexity.asr_acc, self.complexity.asr_std)
         conf = np.clip(conf, 0.1, 0.99)
         noisy_actions = []
         # check has yes no
@@ -37,16 +37,16 @@ class EnvironmentNoise(AbstractNoise):
 
         for a in actions:
             if a.act == UserAct.CONFIRM:
-                if np.random.rand() > conf:
-                    a.act = UserAct.DISCONFIRM
+                if self.rng.rand() > conf:
+                    a = a.replace(act=UserAct.DISCONFIRM)
             elif a.act == UserAct.DISCONFIRM:
-                if np.random.rand() > conf:
-                    a.act = UserAct.CONFIRM
+                if self.rng.rand() > conf:
+                    a = a.replace(act=UserAct.CONFIRM)
             elif a.act == UserAct.INFORM:
-                if np.random.rand() > conf:
+                if self.rng.rand() > conf:
                     slot, value = a.parameters[0]
                     choices = range(self.dim_map[slot]) + [None]
-                    a.parameters[0] = (slot, np.random.choice(choices))
+                    a = a.replace(parameters=[(slot, self.rng.choice(choices))] + list(a.parameters[1:]))
 
             noisy_actions.append(a)
 
@@ -67,25 +67,27 @@ class InteractionNoise(AbstractNoise):
 
     def add_hesitation(self, utt):
         tokens = utt.split(" ")
-        if len(tokens) > 4 and  np.random.rand() < self.complexity.hesitation:
-            pos = np.random.randint(1, len(tokens)-1)
-            tokens.insert(pos, np.random.choice(["hmm", "uhm", "hmm ...",]))
+        if len(tokens) > 4 and  self.rng.rand() < self.complexity.hesitation:
+            pos = self.rng.randint(1, len(tokens)-1)
+            tokens.insert(pos, self.rng.choice(["hmm", "uhm", "hmm ...",]))
             return " ".join(tokens)
         return utt
 
     def add_self_restart(self, utt):
         tokens = utt.split(" ")
-        if len(tokens) > 4 and np.random.rand() < self.complexity.self_restart:
-            length = np.random.randint(1, 3)
+        if len(tokens) > 4 and self.rng.rand() < self.complexity.self_restart:
+            length = self.rng.randint(1, 3)
             tokens = tokens[0:length] + ["uhm yeah"] + tokens
             return " ".join(tokens)
         return utt
 
     def add_self_correct(self, actions):
+        corrected = []
         for a in actions:
-            if a.act == UserAct.INFORM and np.random.rand() < self.complexity.self_correct:
-                a.parameters.append((BaseUsrSlot.SELF_CORRECT, True))
-        return actions
+            if a.act == UserAct.INFORM and self.rng.rand() < self.complexity.self_correct:
+                a = a.with_parameter(BaseUsrSlot.SELF_CORRECT, True)
+            corrected.append(a)
+        return corrected
 
 
 class SocialNoise(AbstractNoise):
@@ -100,10 +102,10 @@ class ActionChannel(object):
     A class to simulate the complex behviaor of human-computer conversation.
     """
 
-    def __init__(self, domain, complexity):
-        self.environment = EnvironmentNoise(domain, complexity)
-        self.interaction = InteractionNoise(domain, complexity)
-        self.social = SocialNoise(domain, complexity)
+    def __init__(self, domain, complexity, rng=None):
+        self.environment = EnvironmentNoise(domain, complexity, rng)
+        self.interaction = InteractionNoise(domain, complexity, rng)
+        self.social = SocialNoise(domain, complexity, rng)
 
     def transmit2sys(self, actions):
         """
@@ -112,8 +114,8 @@ class ActionChannel(object):
         :param actions: a list of clean action from the user to the system
         :return: a list of corrupted actions.
         """
-        action_copy = [copy.deepcopy(a) for a in actions]
-        noisy_actions = self.interaction.transmit(action_copy)
+        # the noise builds new actions, so the clean ones of the user are left untouched
+        noisy_actions = self.interaction.transmit(actions)
         noisy_actions = self.social.transmit(noisy_actions)
         noisy_actions, conf = self.environment.transmit(noisy_actions)
         return noisy_actions, conf
@@ -124,8 +126,8 @@ class WordChannel(object):
     A class to simulate the complex behviaor of human-computer conversation.
     """
 
-    def __init__(self, domain, complexity):
-        self.interaction = InteractionNoise(domain, complexity)
+    def __init__(self, domain, complexity, rng=None):
+        self.interaction = InteractionNoise(domain, complexity, rng)
 
     def transmit2sys(self, utt):
         """
@@ -1,5 +1,9 @@
+from collections import OrderedDict
 import numpy as np
 import logging
+import shutil
+import json
+import os
 
 
 class Database(object):
@@ -12,18 +16,44 @@ class Database(object):
     :ivar usr_modalities: the vocab size of each column : List
     :ivar usr_pdf: the PDF for each columns : 2D list
     :ivar num_rows: the number of entries
-    :ivar table: the content : 2D list [[] *num_rows]
-    :ivar indexes: for efficient SELECT : [{attribute_word -> corresponding rows}]
+    :ivar table: the content : 2D array [num_rows, num_usr_slots] of the smallest uint dtype that fits
+    :ivar sys_table: the UID and the non-searchable attributes : 2D array [num_rows, num_sys_slots+1]
+    :ivar unique_rows: the distinct rows of the table : 2D array
+    :ivar indexes: for efficient SELECT : [2D uint8 array [modality, num_rows/8]] of packed row bitmaps per attribute
+    :ivar index_rows: inverted index in CSR format : [1D array of the row ids grouped by value] per attribute
+    :ivar index_offsets: [1D array [modality+1]] per attribute, the rows with value m are
+    index_rows[a][index_offsets[a][m]:index_offsets[a][m+1]] in increasing order
+    :ivar joint_counts: for COUNT : {(a, b) -> 2D array [modality_a, modality_b]} the number of rows of every
+    value pair of the attributes a < b
+    :ivar cache: LRU cache of SELECT : OrderedDict {query tuple -> (entries, index)}
     """
 
     logger = logging.getLogger(__name__)
+    CACHE_SIZE = 4096
+    # larger results are not cached, so that a cache of a huge table stays small
+    CACHE_MAX_ROWS = 1 << 16
+    SNAPSHOT_ARRAYS = ['table', 'sys_table', 'unique_rows']
+    # rows processed at once when building the tables. A multiple of 8 to keep the packed bitmaps aligned
+    CHUNK_ROWS = 1 << 20
+    # the max number of possible distinct rows to find the unique ones with a dense bitmap
+    MAX_DENSE_CODES = 1 << 24
+    # the max number of cells of a precomputed joint count table of two attributes
+    MAX_JOINT_CELLS = 1 << 20
+    # the number of set bits of every byte value
+    POPCOUNT = np.array([bin(b).count("1") for b in range(256)], dtype=np.int64)
 
-    def __init__(self, usr_dirichlet_priors, sys_dirichlet_priors, num_rows):
+    def __init__(self, usr_dirichlet_priors, sys_dirichlet_priors, num_rows, rng=None, cache_size=None,
+                 storage_dir=None):
         """
         :param usr_dirichlet_priors: 2D list [[]_0, []_1, ... []_k] for each searchable attributes
         :param sys_dirichlet_priors: 2D llst for each entry (non-searchable attributes)
         :param num_rows: the number of row in the database
+        :param rng: the numpy RandomState used to sample the table. None to use the global one
+        :param cache_size: the max number of cached SELECT results. None to use CACHE_SIZE, 0 to disable
+        :param storage_dir: if given, the tables and indexes are memory-mapped .npy files in this folder
+        instead of living in memory, for databases that do not fit in RAM
         """
+        rng = np.random if rng is None else rng
         self.usr_dirichlet_priors = usr_dirichlet_priors
         self.sys_dirichlet_priors = sys_dirichlet_priors
 
@@ -34,66 +64,366 @@ class Database(object):
         self.sys_modalities = [len(p) for p in sys_dirichlet_priors]
 
         # sample attr_pdf for each attribute from the dirichlet prior
-        self.usr_pdf = [np.random.dirichlet(d_p) for d_p in self.usr_dirichlet_priors]
-        self.sys_pdf = [np.random.dirichlet(d_p) for d_p in self.sys_dirichlet_priors]
+        self.usr_pdf = [rng.dirichlet(d_p) for d_p in self.usr_dirichlet_priors]
+        self.sys_pdf = [rng.dirichlet(d_p) for d_p in self.sys_dirichlet_priors]
         self.num_rows = num_rows
 
-        # begin to generate the table
-        usr_table, usr_index = self._gen_table(self.usr_pdf, self.usr_modalities, self.num_usr_slots, num_rows)
-        sys_table, sys_index = self._gen_table(self.sys_pdf, self.sys_modalities, self.num_sys_slots, num_rows)
+        self.storage_dir = storage_dir
+        if storage_dir is not None and not os.path.exists(storage_dir):
+            os.makedirs(storage_dir)
 
-        # append the UID in the first column
-        sys_table.insert(0, range(self.num_rows))
+        # begin to generate the table, column by column so that column-major storage is written sequentially
+        self.table = self._alloc("table", (num_rows, self.num_usr_slots),
+                                 self.min_dtype(max(self.usr_modalities + [1])), fortran_order=True)
+        self.sys_table = self._alloc("sys_table", (num_rows, self.num_sys_slots+1),
+                                     self.min_dtype(max(self.sys_modalities + [num_rows])), fortran_order=True)
+        self._gen_table(self.table, self.usr_pdf, 0, rng)
+        self._gen_table(self.sys_table, self.sys_pdf, 1, rng)
 
-        self.table = np.array(usr_table).transpose()
-        self.indexes = usr_index
-        self.sys_table = np.array(sys_table).transpose()
+        # the UID in the first column
+        for start, stop in self._chunks():
+            self.sys_table[start:stop, 0] = np.arange(start, stop)
+
+        self.cache_size = self.CACHE_SIZE if cache_size is None else cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.reindex()
+
+    def reindex(self):
+        """
+        Rebuild everything derived from the table. It must be called after the table is changed.
+        """
+        self.indexes, self.index_rows, self.index_offsets = self._gen_indexes()
+        self.joint_counts = self._gen_joint_counts()
+        # the distinct rows are the user goals, sorted once for all the sampling
+        self.unique_rows = self._gen_unique_rows()
+        self.clear_cache()
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def save(self, path):
+        """
+        Save a snapshot of the database into the folder path: one .npy file per array, so that it can be
+        memory-mapped, plus the priors and pdfs in meta.json. The folder is written under a temporary name
+        and renamed when complete, so a concurrent reader never sees a partial snapshot.
+
+        :param path: the snapshot folder
+        """
+        tmp_path = "%s.tmp.%d" % (path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in self.SNAPSHOT_ARRAYS:
+            np.save(os.path.join(tmp_path, name + ".npy"), getattr(self, name))
+        for a_id in range(self.num_usr_slots):
+            np.save(os.path.join(tmp_path, "index-%d.npy" % a_id), self.indexes[a_id])
+            np.save(os.path.join(tmp_path, "index-rows-%d.npy" % a_id), self.index_rows[a_id])
+            np.save(os.path.join(tmp_path, "index-offsets-%d.npy" % a_id), self.index_offsets[a_id])
+        for (a_id, b_id), counts in self.joint_counts.items():
+            np.save(os.path.join(tmp_path, "joint-%d-%d.npy" % (a_id, b_id)), counts)
+
+        meta = {'num_rows': self.num_rows,
+                'usr_dirichlet_priors': [np.asarray(p).tolist() for p in self.usr_dirichlet_priors],
+                'sys_dirichlet_priors': [np.asarray(p).tolist() for p in self.sys_dirichlet_priors],
+                'usr_pdf': [p.tolist() for p in self.usr_pdf],
+                'sys_pdf': [p.tolist() for p in self.sys_pdf]}
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process may have saved the same snapshot in the meantime
+            shutil.rmtree(tmp_path)
+            if not os.path.isdir(path):
+                raise
+
+    @classmethod
+    def load(cls, path, mmap=True, cache_size=None):
+        """
+        Load a snapshot written by save without sampling anything.
+
+        :param path: the snapshot folder
+        :param mmap: True to memory-map the arrays read-only instead of reading them into memory
+        :param cache_size: the max number of cached SELECT results. None to use CACHE_SIZE, 0 to disable
+        :return: a Database
+        """
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        db = cls.__new__(cls)
+        db.usr_dirichlet_priors = [np.array(p) for p in meta['usr_dirichlet_priors']]
+        db.sys_dirichlet_priors = [np.array(p) for p in meta['sys_dirichlet_priors']]
+        db.num_usr_slots = len(db.usr_dirichlet_priors)
+        db.usr_modalities = [len(p) for p in db.usr_dirichlet_priors]
+        db.num_sys_slots = len(db.sys_dirichlet_priors)
+        db.sys_modalities = [len(p) for p in db.sys_dirichlet_priors]
+        db.usr_pdf = [np.array(p) for p in meta['usr_pdf']]
+        db.sys_pdf = [np.array(p) for p in meta['sys_pdf']]
+        db.num_rows = meta['num_rows']
+        db.storage_dir = None
+
+        for name in cls.SNAPSHOT_ARRAYS:
+            setattr(db, name, np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode))
+        db.indexes = [np.load(os.path.join(path, "index-%d.npy" % a_id), mmap_mode=mmap_mode)
+                      for a_id in range(db.num_usr_slots)]
+        db.index_rows = [np.load(os.path.join(path, "index-rows-%d.npy" % a_id), mmap_mode=mmap_mode)
+                         for a_id in range(db.num_usr_slots)]
+        db.index_offsets = [np.load(os.path.join(path, "index-offsets-%d.npy" % a_id))
+                            for a_id in range(db.num_usr_slots)]
+        db.joint_counts = {}
+        for a_id, b_id in db._joint_pairs():
+            db.joint_counts[(a_id, b_id)] = np.load(os.path.join(path, "joint-%d-%d.npy" % (a_id, b_id)))
+
+        db.cache_size = cls.CACHE_SIZE if cache_size is None else cache_size
+        db.cache = OrderedDict()
+        db.cache_hits = 0
+        db.cache_misses = 0
+        return db
 
     @staticmethod
-    def _gen_table(pdf, modalities, num_cols, num_rows):
-        list_table = []
-        indexes = []
-        for idx in range(num_cols):
-            col = np.random.choice(range(modalities[idx]), p=pdf[idx], size=num_rows)
-            list_table.append(col)
-            # indexing
-            index = {}
-            for m_id in range(modalities[idx]):
-                matched_list = np.squeeze(np.argwhere(col == m_id)).tolist()
-                matched_list = set(matched_list) if type(matched_list) is list else {matched_list}
-                index[m_id] = matched_list
-            indexes.append(index)
-        return list_table, indexes
-
-    def sample_unique_row(self):
+    def min_dtype(num_values):
+        """
+        :return: the smallest unsigned integer dtype that holds the values 0 to num_values-1
+        """
+        for dtype in [np.uint8, np.uint16, np.uint32]:
+            if num_values - 1 <= np.iinfo(dtype).max:
+                return dtype
+        return np.uint64
+
+    def _alloc(self, name, shape, dtype, fortran_order=False):
+        # zero filled, like a new memory-mapped file
+        if self.storage_dir is None:
+            return np.zeros(shape, dtype=dtype, order='F' if fortran_order else 'C')
+        return np.lib.format.open_memmap(os.path.join(self.storage_dir, name + ".npy"), mode='w+',
+                                         dtype=dtype, shape=shape, fortran_order=fortran_order)
+
+    def _chunks(self):
+        for start in range(0, self.num_rows, self.CHUNK_ROWS):
+            yield start, min(start + self.CHUNK_ROWS, self.num_rows)
+
+    def _gen_table(self, table, pdf, offset, rng):
+        # the chunks of a column are drawn in order, so the table only depends on the seed and not on CHUNK_ROWS
+        for idx, p in enumerate(pdf):
+            for start, stop in self._chunks():
+                table[start:stop, offset+idx] = rng.choice(len(p), p=p, size=stop-start)
+
+    def _gen_indexes(self):
+        """
+        Build the index of every column with one stable argsort and bincount pass per chunk of rows, so the
+        time is linear in the number of rows and does not depend on the modality.
+
+        :return: the packed bitmaps, the CSR row ids and the CSR offsets of every column
+        """
+        indexes, index_rows, index_offsets = [], [], []
+        num_bytes = (self.num_rows + 7) // 8
+        row_dtype = self.min_dtype(self.num_rows)
+        for idx, modality in enumerate(self.usr_modalities):
+            counts = np.zeros(modality, dtype=np.int64)
+            for start, stop in self._chunks():
+                counts += np.bincount(self.table[start:stop, idx], minlength=modality)
+            offsets = np.zeros(modality+1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+
+            bitmaps = self._alloc("index-%d" % idx, (modality, num_bytes), np.uint8)
+            rows = self._alloc("index-rows-%d" % idx, (self.num_rows,), row_dtype)
+            flat_bitmaps = bitmaps.reshape(-1)
+            next_pos = offsets[0:-1].copy()
+            for start, stop in self._chunks():
+                col = self.table[start:stop, idx]
+                # the rows of the chunk grouped by value, each group in increasing row order
+                order = np.argsort(col, kind='mergesort')
+                values = col[order].astype(np.int64)
+                chunk_counts = np.bincount(col, minlength=modality)
+                chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+                dest = np.repeat(next_pos - chunk_starts, chunk_counts) + np.arange(len(order))
+                chunk_rows = order + start
+                rows[dest] = chunk_rows
+                next_pos += chunk_counts
+
+                # (value, byte) keys are sorted as well, so the bits of each byte are OR-ed with one reduceat
+                keys = values * num_bytes + (chunk_rows >> 3)
+                bits = (128 >> (chunk_rows & 7)).astype(np.uint8)
+                key_starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[0:-1])))
+                flat_bitmaps[keys[key_starts]] = np.bitwise_or.reduceat(bits, key_starts)
+
+            indexes.append(bitmaps)
+            index_rows.append(rows)
+            index_offsets.append(offsets)
+        return indexes, index_rows, index_offsets
+
+    def _joint_pairs(self):
+        """
+        :return: the pairs of attributes (a, b), a < b, whose joint count table is small enough to keep
         """
+        return [(a_id, b_id) for a_id in range(self.num_usr_slots) for b_id in range(a_id+1, self.num_usr_slots)
+                if self.usr_modalities[a_id] * self.usr_modalities[b_id] <= self.MAX_JOINT_CELLS]
+
+    def _gen_joint_counts(self):
+        joint_counts = {}
+        for a_id, b_id in self._joint_pairs():
+            m_a, m_b = self.usr_modalities[a_id], self.usr_modalities[b_id]
+            counts = np.zeros(m_a * m_b, dtype=np.int64)
+            for start, stop in self._chunks():
+                codes = self.table[start:stop, a_id].astype(np.int64) * m_b + self.table[start:stop, b_id]
+                counts += np.bincount(codes, minlength=m_a * m_b)
+            joint_counts[(a_id, b_id)] = counts.reshape(m_a, m_b)
+        return joint_counts
+
+    def rows_of(self, slot_id, value):
+        """
+        :return: the ids of the rows whose attribute slot_id equals value, in increasing order
+        """
+        offsets = self.index_offsets[slot_id]
+        return self.index_rows[slot_id][offsets[value]:offsets[value+1]]
+
+    def _gen_unique_rows(self):
+        """
+        :return: the distinct rows of the table in lexicographic order, like np.unique(table, axis=0)
+        """
+        # encode every row as one integer in the mixed radix of the modalities, which keeps the order
+        num_codes = 1
+        for m in self.usr_modalities:
+            num_codes *= m
+        if num_codes > np.iinfo(np.int64).max:
+            return np.unique(self.table, axis=0)
+
+        if num_codes <= self.MAX_DENSE_CODES:
+            seen = np.zeros(num_codes, dtype=np.bool_)
+            for start, stop in self._chunks():
+                seen[np.ravel_multi_index(self.table[start:stop].T, self.usr_modalities)] = True
+            codes = np.flatnonzero(seen)
+        else:
+            codes = np.unique(np.concatenate(
+                [np.unique(np.ravel_multi_index(self.table[start:stop].T, self.usr_modalities))
+                 for start, stop in self._chunks()]))
+        return np.array(np.unravel_index(codes, self.usr_modalities), dtype=self.table.dtype).T
+
+    def sample_unique_row(self, rng=None):
+        """
+        :param rng: the numpy RandomState to sample from. None to use the global one
         :return: a unique row in the searchable table
         """
-        unique_rows = np.unique(self.table, axis=0)
-        idxes = range(len(unique_rows))
-        np.random.shuffle(idxes)
-        return unique_rows[idxes[0]]
+        rng = np.random if rng is None else rng
+        return self.unique_rows[rng.randint(0, len(self.unique_rows))]
 
     def select(self, query, return_index=False):
         """
-        Filter the database entries according the query.
+        Filter the database entries according the query. The results of the recent queries are cached
+        and shared between the callers, so the returned entries are read-only.
         
-        :param query: 1D [] equal to the number of attributes, None means don't care
+        :param query: 1D [] equal to the number of attributes, None means don't care. A row is valid
+        if it matches every value that is not None, which is a vectorized AND of the packed bitmaps.
         :param return_index: if return the db index
         :return return a list system_entries and (optional)index that satisfy all constrains
         
         """
-        valid_idx = set(range(self.num_rows))
-        for q, a_id in zip(query, range(self.num_usr_slots)):
-            if q:
-                valid_idx -= self.indexes[a_id][q]
-                if len(valid_idx) == 0:
-                    break
-        valid_idx = list(valid_idx)
+        valid_entries, valid_idx = self._cached_select(query)
         if return_index:
-            return self.sys_table[valid_idx, :], valid_idx
+            return valid_entries, range(self.num_rows) if valid_idx is None else valid_idx.tolist()
         else:
-            return self.sys_table[valid_idx, :]
+            return valid_entries
+
+    def refine(self, query, valid_idx, constrains):
+        """
+        Select the entries of query, given the rows of a previous select that only lacked some constrains.
+        The previous rows are filtered if they are fewer than the rows of the new constrains, otherwise
+        it is a select of query.
+
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :param valid_idx: the row ids of the previous select, None for all the rows
+        :param constrains: the (attribute id, value) of query that the previous select did not have
+        :return: the read-only entries and the row ids (None for all the rows) that satisfy query
+        """
+        if valid_idx is not None and len(constrains) > 0:
+            sizes = [self.index_offsets[a_id][q+1] - self.index_offsets[a_id][q] for a_id, q in constrains]
+            if len(valid_idx) <= min(sizes):
+                for a_id, q in constrains:
+                    valid_idx = valid_idx[self.table[valid_idx, a_id] == q]
+                valid_entries = self.sys_table[valid_idx, :]
+                valid_entries.flags.writeable = False
+                return valid_entries, valid_idx
+        return self._cached_select(query)
+
+    def _cached_select(self, query):
+        """
+        :return: the read-only entries and row ids (None for all the rows) of query, from the LRU cache
+        """
+        # numpy integers hash and compare equal to the python ones
+        key = tuple(query)
+        result = self.cache.pop(key, None)
+        if result is None:
+            self.cache_misses += 1
+            result = self._select(key)
+            if len(self.cache) >= self.cache_size > 0:
+                self.cache.popitem(last=False)
+        else:
+            self.cache_hits += 1
+        if self.cache_size > 0 and len(result[0]) <= self.CACHE_MAX_ROWS:
+            # re-insert as the most recently used
+            self.cache[key] = result
+        return result
+
+    def count(self, query):
+        """
+        Count the entries that satisfy the query without selecting them. Queries with up to two constrains
+        are answered from precomputed counts, the others by counting the bits of the AND of the bitmaps.
+
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the number of rows that satisfy all constrains
+        """
+        constrains = [(a_id, q) for a_id, q in enumerate(query) if q is not None]
+        if len(constrains) == 0:
+            return self.num_rows
+        if len(constrains) == 1:
+            a_id, q = constrains[0]
+            return int(self.index_offsets[a_id][q+1] - self.index_offsets[a_id][q])
+        if len(constrains) == 2:
+            (a_id, q_a), (b_id, q_b) = constrains
+            counts = self.joint_counts.get((a_id, b_id))
+            if counts is not None:
+                return int(counts[q_a, q_b])
+
+        result = self.cache.get(tuple(query))
+        if result is not None:
+            return len(result[0])
+        mask = self.indexes[constrains[0][0]][constrains[0][1]].copy()
+        for a_id, q in constrains[1:]:
+            np.bitwise_and(mask, self.indexes[a_id][q], out=mask)
+        # the padding bits of the last byte are never set
+        return int(self.POPCOUNT[mask].sum())
+
+    def _select(self, query):
+        constrains = [(a_id, q) for a_id, q in enumerate(query) if q is not None]
+        if len(constrains) == 0:
+            # no constrain, every row is valid
+            valid_entries = self.sys_table.view()
+            valid_entries.flags.writeable = False
+            return valid_entries, None
+
+        # start from the shortest list of rows if it is cheaper than one pass over a bitmap
+        sizes = [self.index_offsets[a_id][q+1] - self.index_offsets[a_id][q] for a_id, q in constrains]
+        shortest = min(range(len(sizes)), key=sizes.__getitem__)
+        if sizes[shortest] * 8 <= self.num_rows:
+            valid_idx = self.rows_of(*constrains.pop(shortest))
+            for a_id, q in constrains:
+                if len(valid_idx) > 0:
+                    valid_idx = valid_idx[self.table[valid_idx, a_id] == q]
+            valid_idx = valid_idx.astype(np.intp)
+        else:
+            mask = self.indexes[constrains[0][0]][constrains[0][1]].copy()
+            for a_id, q in constrains[1:]:
+                np.bitwise_and(mask, self.indexes[a_id][q], out=mask)
+            valid_idx = np.flatnonzero(np.unpackbits(mask)[0:self.num_rows])
+
+        valid_entries = self.sys_table[valid_idx, :]
+        valid_entries.flags.writeable = False
+        return valid_entries, valid_idx
 
     def pprint(self):
         """
@@ -101,4 +431,7 @@ class Database(object):
         """
 
         self.logger.info("DB contains %d rows (%d unique ones), with %d attributes"
-                         % (self.num_rows, len(np.unique(self.table, axis=0)), self.num_usr_slots))
+                         % (self.num_rows, len(self.unique_rows), self.num_usr_slots))
+        if self.cache_hits + self.cache_misses > 0:
+            self.logger.info("SELECT cache: %d hits, %d misses, %d/%d entries"
+                             % (self.cache_hits, self.cache_misses, len(self.cache), self.cache_size))
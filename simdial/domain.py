@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
 from simdial.database import Database
+from simdial.sqlite_database import SqliteDatabase
 import numpy as np
 from simdial.agent.core import BaseSysSlot
+import hashlib
 import logging
+import json
+import os
 
 
 class DomainSpec(object):
@@ -44,30 +48,68 @@ class Slot(object):
         self.informs = []
         self.yn_questions = {}
 
-    def sample_request(self):
+    def sample_request(self, rng=None):
+        rng = np.random if rng is None else rng
         if self.requests:
-            return np.random.choice(self.requests)
+            return rng.choice(self.requests)
         else:
             raise ValueError("Sample from empty request_utt pool")
 
-    def sample_inform(self):
+    def sample_inform(self, rng=None):
+        rng = np.random if rng is None else rng
         if self.informs:
-            return np.random.choice(self.informs)
+            return rng.choice(self.informs)
         else:
             raise ValueError("Sample from empty inform_utt pool")
 
-    def sample_yn_question(self, expect_val):
+    def sample_yn_question(self, expect_val, rng=None):
+        rng = np.random if rng is None else rng
         questions = self.yn_questions.get(expect_val, [])
         if questions:
-            return np.random.choice(questions)
+            return rng.choice(questions)
         else:
             raise ValueError("Sample from empty yn_questions pool")
 
-    def sample_different(self, value):
+    def sample_different(self, value, rng=None):
+        rng = np.random if rng is None else rng
         if value is None:
-            return np.random.randint(0, self.dim)
+            return rng.randint(0, self.dim)
         else:
-            return np.random.choice([None] + [i for i in range(self.dim) if i != value])
+            return rng.choice([None] + [i for i in range(self.dim) if i != value])
+
+
+def _to_str(obj):
+    """
+    :return: obj with the unicode strings of json.load turned back into str, as in a DomainSpec
+    """
+    if isinstance(obj, dict):
+        return {_to_str(k): _to_str(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_to_str(v) for v in obj]
+    if not isinstance(obj, str) and isinstance(obj, type(u"")):
+        return obj.encode('utf-8')
+    return obj
+
+
+class IndexVocabulary(object):
+    """
+    The vocabulary of the DEFAULT slot, i.e. the string of every row id, without materializing a list of
+    num_rows strings.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.size:
+            raise IndexError("vocabulary index out of range")
+        return str(idx)
+
+    def __iter__(self):
+        for idx in range(self.size):
+            yield str(idx)
 
 
 class Domain(object):
@@ -79,19 +121,29 @@ class Domain(object):
     that contains slot_name, slot_description, dimension
     :ivar usr_slots: a list of slots that users can impose a constrains. Each slot is a dictionary 
     that contains slot_name, slot_description, dimension
+    :ivar usr_slot_names: a frozenset of the names of usr_slots
+    :ivar usr_slot_lookup: slot name -> (slot, index) of usr_slots
+    :ivar sys_slot_lookup: slot name -> (slot, index) of sys_slots
     """
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, domain_spec):
+    def __init__(self, domain_spec, seed=None, snapshot_dir=None, storage_dir=None, db_path=None):
         """
         :param domain_spec: an implementation of DomainSpec
+        :param seed: the seed used to sample the database. None to use the global numpy random state
+        :param snapshot_dir: a folder of database snapshots. If given, the database of this spec and seed
+        is loaded from it, or sampled and saved into it the first time
+        :param storage_dir: an optional folder to memory-map the tables of a new database, see Database
+        :param db_path: an existing SQLite file to use as the database instead of sampling one, see
+        SqliteDatabase. Its uid column must number the entries from 0.
         """
         self.name = domain_spec.name
         self.greet = domain_spec.greet
         self.usr_slots = [Slot("#"+name, desc, vocab) for name, desc, vocab in domain_spec.usr_slots]
         self.sys_slots = [Slot("#"+name, desc, vocab) for name, desc, vocab in domain_spec.sys_slots]
-        self.sys_slots.insert(0, Slot(BaseSysSlot.DEFAULT, "", [str(i) for i in range(domain_spec.db_size)]))
+        self.sys_slots.insert(0, Slot(BaseSysSlot.DEFAULT, "", IndexVocabulary(domain_spec.db_size)))
+        self._build_lookups()
 
         for slot_name, slot_nlg in domain_spec.nlg_spec.items():
             slot_name = "#"+slot_name
@@ -106,8 +158,110 @@ class Domain(object):
         # we left out DEFAULT from prior since it'e KEY
         sys_slot_priors = [np.ones(s.dim) for s in self.sys_slots[1:]]
 
-        self.db = Database(usr_slot_priors, sys_slot_priors, num_rows=domain_spec.db_size)
+        if db_path is not None:
+            self.db = SqliteDatabase(db_path, [name for name, _, _ in domain_spec.usr_slots],
+                                     [name for name, _, _ in domain_spec.sys_slots])
+            # the entries of the catalog, not the db_size of the spec
+            self.sys_slots[0].vocabulary = IndexVocabulary(self.db.num_rows)
+            self.sys_slots[0].dim = self.db.num_rows
+            self.db.pprint()
+            return
+
+        if snapshot_dir is not None:
+            if seed is None:
+                raise ValueError("A database snapshot requires a seed")
+            snapshot_path = os.path.join(snapshot_dir, "%s-%s-%d" % (self.name, self.spec_hash(domain_spec), seed))
+            if os.path.isdir(snapshot_path):
+                self.logger.info("Load database snapshot %s" % snapshot_path)
+                self.db = Database.load(snapshot_path)
+                self.db.pprint()
+                return
+
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        self.db = Database(usr_slot_priors, sys_slot_priors, num_rows=domain_spec.db_size, rng=rng,
+                           storage_dir=storage_dir)
         self.db.pprint()
+        if snapshot_dir is not None:
+            self.logger.info("Save database snapshot %s" % snapshot_path)
+            self.db.save(snapshot_path)
+
+    def _build_lookups(self):
+        self.usr_slot_names = frozenset([s.name for s in self.usr_slots])
+        self.usr_slot_lookup = {s.name: (s, s_id) for s_id, s in enumerate(self.usr_slots)}
+        self.sys_slot_lookup = {s.name: (s, s_id) for s_id, s in enumerate(self.sys_slots)}
+
+    def compile(self, path):
+        """
+        Save the built domain into the folder path: the slots with their vocabularies and NLG templates in
+        domain.json, and a snapshot of the database in path/db (or the SQLite file it uses). Domain.load
+        then restores it without parsing the spec or sampling anything, and the processes that load it
+        share one memory-mapped copy of the database through the page cache.
+
+        :param path: the output folder
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        def dump_slot(slot):
+            vocab = None if isinstance(slot.vocabulary, IndexVocabulary) else list(slot.vocabulary)
+            # yn_questions is keyed by vocabulary values, which may be ints that json would turn into str
+            return {'name': slot.name, 'description': slot.description, 'vocabulary': vocab, 'dim': slot.dim,
+                    'requests': slot.requests, 'informs': slot.informs,
+                    'yn_questions': sorted(slot.yn_questions.items())}
+
+        artifact = {'name': self.name, 'greet': self.greet,
+                    'usr_slots': [dump_slot(s) for s in self.usr_slots],
+                    'sys_slots': [dump_slot(s) for s in self.sys_slots]}
+        if isinstance(self.db, SqliteDatabase):
+            artifact['db_path'] = os.path.abspath(self.db.path)
+        else:
+            if os.path.exists(os.path.join(path, "db")):
+                raise ValueError("%s already contains a compiled domain" % path)
+            self.db.save(os.path.join(path, "db"))
+
+        with open(os.path.join(path, "domain.json"), "w") as f:
+            json.dump(artifact, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a domain written by compile.
+
+        :param path: the folder of the compiled domain
+        :param mmap: True to memory-map the database arrays read-only
+        :return: a Domain
+        """
+        with open(os.path.join(path, "domain.json")) as f:
+            artifact = _to_str(json.load(f))
+
+        def load_slot(spec):
+            vocab = IndexVocabulary(spec['dim']) if spec['vocabulary'] is None else spec['vocabulary']
+            slot = Slot(spec['name'], spec['description'], vocab)
+            slot.requests = spec['requests']
+            slot.informs = spec['informs']
+            slot.yn_questions = dict((value, questions) for value, questions in spec['yn_questions'])
+            return slot
+
+        domain = cls.__new__(cls)
+        domain.name = artifact['name']
+        domain.greet = artifact['greet']
+        domain.usr_slots = [load_slot(s) for s in artifact['usr_slots']]
+        domain.sys_slots = [load_slot(s) for s in artifact['sys_slots']]
+        domain._build_lookups()
+        if 'db_path' in artifact:
+            domain.db = SqliteDatabase(artifact['db_path'], [s.name[1:] for s in domain.usr_slots],
+                                       [s.name[1:] for s in domain.sys_slots[1:]])
+        else:
+            domain.db = Database.load(os.path.join(path, "db"), mmap=mmap)
+        return domain
+
+    @staticmethod
+    def spec_hash(domain_spec):
+        """
+        :return: a short hash of the slots and the size of a DomainSpec, which determine its database
+        """
+        key = json.dumps([domain_spec.usr_slots, domain_spec.sys_slots, domain_spec.db_size], sort_keys=True)
+        return hashlib.md5(key.encode('utf-8')).hexdigest()[0:12]
 
     def get_usr_slot(self, slot_name, return_idx=False):
         """
@@ -115,13 +269,9 @@ class Domain(object):
         :param return_idx: True/False to return slot index
         :return: slot, (index) or None if it's not user slot
         """
-        for s_id, s in enumerate(self.usr_slots):
-            if s.name == slot_name:
-                if return_idx:
-                    return s, s_id
-                else:
-                    return s
-        return None
+        if slot_name not in self.usr_slot_lookup:
+            return None
+        return self.usr_slot_lookup[slot_name] if return_idx else self.usr_slot_lookup[slot_name][0]
 
     def get_sys_slot(self, slot_name, return_idx=False):
         """
@@ -129,17 +279,13 @@ class Domain(object):
         :param return_idx: True/False to return slot index
         :return: slot, (index) or None if it's not system slot
         """
-        for s_id, s in enumerate(self.sys_slots):
-            if s.name == slot_name:
-                if return_idx:
-                    return s, s_id
-                else:
-                    return s
-        return None
+        if slot_name not in self.sys_slot_lookup:
+            return None
+        return self.sys_slot_lookup[slot_name] if return_idx else self.sys_slot_lookup[slot_name][0]
 
     def is_usr_slot(self, query_name):
         """
         :param query_name: a slot name
         :return: True if slot_name is user slot, False o/w
         """
-        return query_name in [s.name for s in self.usr_slots]
+        return query_name in self.usr_slot_names
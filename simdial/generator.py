@@ -1,19 +1,43 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
 
+from simdial.agent.core import Action
 from simdial.agent.user import User
 from simdial.agent.system import System
 from simdial.channel import ActionChannel, WordChannel
 from simdial.agent.nlg import SysNlg, UserNlg
 from simdial.complexity import Complexity
 from simdial.domain import Domain
+from simdial.profiler import StageProfiler
+from timeit import default_timer as timer
 import progressbar
+import multiprocessing
+import collections
+import itertools
 import json
 import numpy as np
 import sys
 import os
 import re
 
+
+# per-process state of the worker pool, created once by _init_worker
+_worker_state = None
+
+
+def _init_worker(domain, complexity, state_mode):
+    global _worker_state
+    _worker_state = (Generator(state_mode=state_mode), domain, complexity)
+
+
+def _gen_chunk(args):
+    start, stop, seed, profile = args
+    generator, domain, complexity = _worker_state
+    profiler = StageProfiler() if profile else None
+    dialogs = generator._gen_range(domain, complexity, start, stop, seed, profiler=profiler)
+    return dialogs, profiler
+
+
 class Generator(object):
     """
     The generator class used to generate synthetic slot-filling human-computer conversation in any domain. 
@@ -21,10 +45,29 @@ class Generator(object):
     level. 
     
     The required input is a domain specification dictionary + a configuration dict.
+
+    :cvar MAX_CHUNK_SIZE: the max number of dialogs a worker process generates per task
+    :cvar STATE_MODES: how the system state is stored in the SYS turns. STATE_FULL stores the whole
+    state in every turn. STATE_DELTA stores it in the first turn only, and in the later turns a
+    state_delta of the fields that changed since the previous SYS turn, see expand_states.
+    STATE_NONE does not compute the state at all.
+    :ivar state_mode: one of STATE_MODES
     """
 
+    MAX_CHUNK_SIZE = 100
+    STATE_FULL = "full"
+    STATE_DELTA = "delta"
+    STATE_NONE = "none"
+    STATE_MODES = [STATE_FULL, STATE_DELTA, STATE_NONE]
+
+    def __init__(self, state_mode=STATE_FULL):
+        if state_mode not in self.STATE_MODES:
+            raise ValueError("Unknown state mode %s, expected one of %s" % (state_mode, self.STATE_MODES))
+        self.state_mode = state_mode
+
     @staticmethod
     def pack_msg(speaker, utt, **kwargs):
+        # the actions stay compact Action objects until the dialog is written, see Action.json_default
         resp = {k: v for k, v in kwargs.items()}
         resp["speaker"] = speaker
         resp["utt"] = utt
@@ -42,7 +85,7 @@ class Generator(object):
 
         if in_json:
             combo = {'dialogs': dialogs, 'meta': domain_spec.to_dict()}
-            json.dump(combo, f, indent=2)
+            json.dump(combo, f, indent=2, default=Action.json_default)
         else:
             for idx, d in enumerate(dialogs):
                 f.write("## DIALOG %d ##\n" % idx)
@@ -60,6 +103,97 @@ class Generator(object):
         if output_file is not None:
             f.close()
 
+    @staticmethod
+    def pprint_jsonl(dialogs, domain_spec, output_file, stats=None):
+        """
+        Stream the dialogs into a JSON Lines file, one compact dialog per line. The domain meta is written
+        into a small sidecar file <output_file>.meta.json before the first dialog.
+
+        :param dialogs: an iterable of dialogs, consumed lazily
+        :param domain_spec: the domain specification used to generate the dialogs
+        :param output_file: the path of the .jsonl file
+        :param stats: an optional CorpusStats updated with every written dialog
+        :return: the number of dialogs written
+        """
+        meta_file = os.path.splitext(output_file)[0] + ".meta.json"
+        with open(meta_file, "w") as f:
+            json.dump(domain_spec.to_dict(), f, indent=2)
+
+        cnt = 0
+        with open(output_file, "w") as f:
+            for d in dialogs:
+                f.write(Generator._dump_line(d))
+                # make every dialog visible to readers as soon as it is generated
+                f.flush()
+                if stats is not None:
+                    stats.add(d)
+                cnt += 1
+        return cnt
+
+    @staticmethod
+    def _dump_line(dialog):
+        """
+        :return: a dialog as one compact JSON line. Keys are sorted so the bytes do not depend on which
+        process generated the dialog.
+        """
+        return json.dumps(dialog, sort_keys=True, separators=(',', ':'), default=Action.json_default) + "\n"
+
+    @staticmethod
+    def state_delta(prev_state, state):
+        """
+        :param prev_state: a state summary of DialogState
+        :param state: the next state summary
+        :return: {'usr_slots': {name -> changed fields}, 'sys_goals': {name -> changed fields}, 'kb_update': ...}
+        with only the slots, goals and fields that changed. {} if nothing changed.
+        """
+        delta = {}
+        for key in ['usr_slots', 'sys_goals']:
+            changed = {}
+            for prev, cur in zip(prev_state[key], state[key]):
+                fields = {k: v for k, v in cur.items() if prev[k] != v}
+                if fields:
+                    changed[cur['name']] = fields
+            if changed:
+                delta[key] = changed
+        if prev_state['kb_update'] != state['kb_update']:
+            delta['kb_update'] = state['kb_update']
+        return delta
+
+    @staticmethod
+    def apply_state_delta(prev_state, delta):
+        """
+        :return: the state summary of prev_state updated with a delta of state_delta
+        """
+        state = {'kb_update': delta.get('kb_update', prev_state['kb_update'])}
+        for key in ['usr_slots', 'sys_goals']:
+            changed = delta.get(key, {})
+            state[key] = []
+            for prev in prev_state[key]:
+                cur = dict(prev)
+                cur.update(changed.get(prev['name'], {}))
+                state[key].append(cur)
+        return state
+
+    @staticmethod
+    def expand_states(dialog):
+        """
+        Replace in place the state_delta of the SYS turns of a dialog generated in STATE_DELTA mode by the
+        full state, as in STATE_FULL mode.
+
+        :param dialog: a list of turns
+        :return: dialog
+        """
+        state = None
+        for turn in dialog:
+            if 'state_delta' in turn:
+                if state is None:
+                    raise ValueError("A state_delta without a previous state")
+                state = Generator.apply_state_delta(state, turn.pop('state_delta'))
+                turn['state'] = state
+            elif 'state' in turn:
+                state = turn['state']
+        return dialog
+
     @staticmethod
     def print_stats(dialogs):
         """
@@ -67,92 +201,404 @@ class Generator(object):
         
         :param dialogs: A list of dialogs generated.
         """
-        print("%d dialogs" % len(dialogs))
-        all_lens = [len(d) for d in dialogs]
-        print("Avg len {} Max Len {}".format(np.mean(all_lens), np.max(all_lens)))
-
-        total_cnt = 0.
-        kb_cnt = 0.
-        ratio = []
+        stats = CorpusStats()
         for d in dialogs:
-            local_cnt = 0.
-            for t in d:
-                total_cnt +=1
-                if 'QUERY' in t['utt']:
-                    kb_cnt += 1
-                    local_cnt += 1
-            ratio.append(local_cnt/len(d))
-        print(kb_cnt/total_cnt)
-        print(np.mean(ratio))
-
-    def gen(self, domain, complexity, num_sess=1):
+            stats.add(d)
+        stats.pprint()
+
+    def gen(self, domain, complexity, num_sess=1, workers=1, seed=None, profiler=None):
         """
         Generate synthetic dialogs in the given domain. 
 
         :param domain: a domain specification dictionary
         :param complexity: an implmenetaiton of Complexity
         :param num_sess: how dialogs to generate
-        :return: a list of dialogs. Each dialog is a list of turns.
+        :param workers: the number of processes used to generate the dialogs
+        :param seed: the corpus seed. Dialog i is generated from its own random state seeded by (seed, i),
+        so the corpus is the same for any number of workers. None to draw one from the global random state.
+        :param profiler: an optional StageProfiler that collects the time of every stage of the loop
+        :return: a list of dialogs. Each dialog is a list of turns. The actions of a turn are Action objects,
+        pass default=Action.json_default to json.dump to write them.
+        """
+        dialogs = self.iter_dialogs(domain, complexity, seed=seed, limit=num_sess, workers=workers,
+                                    profiler=profiler)
+        return list(self._progress(dialogs, num_sess))
+
+    def iter_dialogs(self, domain, complexity, seed=None, limit=None, workers=1, start=0, profiler=None):
+        """
+        Lazily generate dialogs one at a time, in the same order as gen.
+
+        :param domain: a domain specification dictionary
+        :param complexity: an implmenetaiton of Complexity
+        :param seed: the corpus seed. None to draw one from the global random state.
+        :param limit: the number of dialogs to generate. None to generate forever.
+        :param workers: the number of processes used to generate the dialogs
+        :param start: the index of the first dialog, e.g. to resume a corpus
+        :param profiler: an optional StageProfiler, which also collects the measurements of the workers
+        :return: an iterator over dialogs. Each dialog is a list of turns.
+        """
+        if seed is None:
+            seed = np.random.randint(0, 2**31-1)
+
+        if workers <= 1:
+            stop = None if limit is None else start + limit
+            for dialog in self._iter_range(domain, complexity, start, stop, seed, profiler=profiler):
+                yield dialog
+            return
+
+        # split the sessions into ordered chunks, several per worker for load balancing
+        if limit is None:
+            chunk_size = self.MAX_CHUNK_SIZE
+        else:
+            chunk_size = max(1, min(self.MAX_CHUNK_SIZE, int(np.ceil(limit / (workers * 4.0)))))
+        end = None if limit is None else start + limit
+        starts = itertools.count(start, chunk_size)
+        if end is not None:
+            starts = itertools.takewhile(lambda s: s < end, starts)
+
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(domain, complexity, self.state_mode))
+        try:
+            # keep a bounded window of chunks in flight and collect them in the submitted order,
+            # so the merge is deterministic and the memory does not grow with limit
+            pending = collections.deque()
+            for chunk_start in starts:
+                chunk_stop = chunk_start + chunk_size if end is None else min(chunk_start + chunk_size, end)
+                args = (chunk_start, chunk_stop, seed, profiler is not None)
+                pending.append(pool.apply_async(_gen_chunk, (args,)))
+                if len(pending) >= workers * 2:
+                    for dialog in self._collect_chunk(pending.popleft(), profiler):
+                        yield dialog
+            while pending:
+                for dialog in self._collect_chunk(pending.popleft(), profiler):
+                    yield dialog
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    @staticmethod
+    def _collect_chunk(result, profiler):
+        """
+        :return: the dialogs of a finished worker chunk, after merging its measurements into profiler
+        """
+        dialogs, chunk_profiler = result.get()
+        if profiler is not None:
+            profiler.merge(chunk_profiler)
+        return dialogs
+
+    @staticmethod
+    def _progress(dialogs, size):
+        """
+        Pass through the dialogs while showing a progressbar.
+        """
+        bar = progressbar.ProgressBar(max_value=size)
+        for i, dialog in enumerate(dialogs):
+            bar.update(i+1)
+            yield dialog
+
+    def _gen_range(self, domain, complexity, start, stop, seed, profiler=None):
+        """
+        :return: a list of the dialogs with index in [start, stop).
+        """
+        return list(self._iter_range(domain, complexity, start, stop, seed, profiler=profiler))
+
+    def _iter_range(self, domain, complexity, start, stop, seed, profiler=None):
         """
-        dialogs = []
-        action_channel = ActionChannel(domain, complexity)
-        word_channel = WordChannel(domain, complexity)
+        Generate the dialogs with index in [start, stop).
+
+        :param stop: the end index, None to never stop
+        :param seed: the corpus seed
+        :param profiler: an optional StageProfiler
+        :return: an iterator over dialogs.
+        """
+
+        indexes = itertools.count(start)
+        if stop is not None:
+            indexes = itertools.islice(indexes, max(0, stop - start))
+
+        # one random state shared by all the components, re-seeded at the start of every dialog
+        rng = np.random.RandomState()
+
+        action_channel = ActionChannel(domain, complexity, rng)
+        word_channel = WordChannel(domain, complexity, rng)
 
         # natural language generators
-        sys_nlg = SysNlg(domain, complexity)
-        usr_nlg = UserNlg(domain, complexity)
-
-        bar = progressbar.ProgressBar(max_value=num_sess)
-        for i in range(num_sess):
-            bar.update(i)
-            usr = User(domain, complexity)
-            sys = System(domain, complexity)
-
-            # begin conversation
-            noisy_usr_as = []
-            dialog = []
-            conf = 1.0
-            while True:
-                # make a decision
-                sys_r, sys_t, sys_as, sys_s = sys.step(noisy_usr_as, conf)
-                sys_utt, sys_str_as = sys_nlg.generate_sent(sys_as, domain=domain)
-                dialog.append(self.pack_msg("SYS", sys_utt, actions=sys_str_as, domain=domain.name, state=sys_s))
+        sys_nlg = SysNlg(domain, complexity, rng)
+        usr_nlg = UserNlg(domain, complexity, rng)
 
-                if sys_t:
-                    break
+        for i in indexes:
+            rng.seed([seed, i])
+            yield self._run_dialog(domain, complexity, rng, action_channel, word_channel, sys_nlg, usr_nlg,
+                                   profiler)
 
-                usr_r, usr_t, usr_as = usr.step(sys_as)
+    def _run_dialog(self, domain, complexity, rng, action_channel, word_channel, sys_nlg, usr_nlg, profiler=None):
+        """
+        Simulate one dialog.
 
-                # passing through noise, nlg and noise!
-                noisy_usr_as, conf = action_channel.transmit2sys(usr_as)
-                usr_utt = usr_nlg.generate_sent(noisy_usr_as)
-                noisy_usr_utt = word_channel.transmit2sys(usr_utt)
+        :param profiler: an optional StageProfiler. If None, the stages are called directly.
+        :return: the dialog as a list of turns.
+        """
+        if profiler is not None:
+            started = timer()
 
-                dialog.append(self.pack_msg("USR", noisy_usr_utt, actions=noisy_usr_as, conf=conf, domain=domain.name))
+        usr = User(domain, complexity, rng)
+        sys = System(domain, complexity, rng, track_state=self.state_mode != self.STATE_NONE)
 
-            dialogs.append(dialog)
+        sys_step, sys_generate = sys.step, sys_nlg.generate_sent
+        usr_step, usr_generate = usr.step, usr_nlg.generate_sent
+        action_transmit, word_transmit = action_channel.transmit2sys, word_channel.transmit2sys
+        if profiler is not None:
+            sys_step = profiler.timed('sys.step', sys_step)
+            sys_generate = profiler.timed('sys_nlg.generate_sent', sys_generate)
+            usr_step = profiler.timed('usr.step', usr_step)
+            action_transmit = profiler.timed('action_channel.transmit2sys', action_transmit)
+            usr_generate = profiler.timed('usr_nlg.generate_sent', usr_generate)
+            word_transmit = profiler.timed('word_channel.transmit2sys', word_transmit)
 
-        return dialogs
+        # begin conversation
+        dialog = []
+        noisy_usr_as = []
+        conf = 1.0
+        prev_s = None
+        while True:
+            # make a decision
+            sys_r, sys_t, sys_as, sys_s = sys_step(noisy_usr_as, conf)
+            sys_utt, sys_str_as = sys_generate(sys_as, domain=domain)
+            if self.state_mode == self.STATE_NONE:
+                dialog.append(self.pack_msg("SYS", sys_utt, actions=sys_str_as, domain=domain.name))
+            elif self.state_mode == self.STATE_DELTA and prev_s is not None:
+                dialog.append(self.pack_msg("SYS", sys_utt, actions=sys_str_as, domain=domain.name,
+                                            state_delta=self.state_delta(prev_s, sys_s)))
+            else:
+                dialog.append(self.pack_msg("SYS", sys_utt, actions=sys_str_as, domain=domain.name, state=sys_s))
+            prev_s = sys_s
+
+            if sys_t:
+                if profiler is not None:
+                    profiler.add_dialog(len(dialog), timer() - started)
+                return dialog
+
+            usr_r, usr_t, usr_as = usr_step(sys_as)
+
+            # passing through noise, nlg and noise!
+            noisy_usr_as, conf = action_transmit(usr_as)
+            usr_utt = usr_generate(noisy_usr_as)
+            noisy_usr_utt = word_transmit(usr_utt)
 
-    def gen_corpus(self, name, domain_spec, complexity_spec, size):
+            # the corpus labels a confirm/disconfirm flipped by the ASR noise with the act the user meant
+            usr_label_as = [n if n.act == a.act else n.replace(act=a.act) for a, n in zip(usr_as, noisy_usr_as)]
+            dialog.append(self.pack_msg("USR", noisy_usr_utt, actions=usr_label_as, conf=conf, domain=domain.name))
+
+    def gen_corpus(self, name, domain_spec, complexity_spec, size, workers=1, seed=None, stream=False,
+                   chunk_size=None, profiler=None, db_seed=None, snapshot_dir=None, db_path=None, domain_path=None,
+                   verbose=True):
+        """
+        Generate a corpus and save it into the folder name.
+
+        :param stream: if True, write each dialog into a .jsonl file as soon as it is generated, so the
+        memory use does not grow with size. Otherwise dump the whole corpus into one .json file.
+        :param chunk_size: if given, write the corpus into a folder of .jsonl chunks with chunk_size dialogs
+        each plus a manifest, and resume from the last finished chunk if the folder already exists.
+        :param profiler: an optional StageProfiler. Its measurements are dumped into a .profile.json file
+        next to the corpus at the end.
+        :param db_seed: the seed of the database. None to use seed. Give the train and test corpora the same
+        db_seed to let them share one database.
+        :param snapshot_dir: an optional folder of database snapshots, see Domain
+        :param db_path: an optional SQLite file to use as the database, see Domain
+        :param domain_path: an optional domain folder written by Domain.compile. It is loaded instead of
+        building the domain from domain_spec, so db_seed, snapshot_dir and db_path are not used.
+        :param verbose: show a progressbar and print the corpus stats
+        :return: the CorpusStats of the corpus
+        """
         if not os.path.exists(name):
-            os.mkdir(name)
+            try:
+                os.mkdir(name)
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(name):
+                    raise
+
+        if chunk_size is not None:
+            out_dir = "{}-{}-{}".format(domain_spec.name, complexity_spec.__name__, size)
+            out_dir = os.path.join(name, out_dir)
+            stats = self._gen_chunks(out_dir, domain_spec, complexity_spec, size, chunk_size, workers=workers,
+                                     seed=seed, profiler=profiler, db_seed=db_seed,
+                                     snapshot_dir=snapshot_dir, db_path=db_path, domain_path=domain_path,
+                                     verbose=verbose)
+            if profiler is not None:
+                profiler.dump(os.path.join(out_dir, "profile.json"))
+            return stats
 
         # create meta specifications
-        domain = Domain(domain_spec)
+        if domain_path is not None:
+            domain = Domain.load(domain_path)
+        else:
+            domain = Domain(domain_spec, seed=seed if db_seed is None else db_seed, snapshot_dir=snapshot_dir,
+                            db_path=db_path)
         complex = Complexity(complexity_spec)
 
-        # generate the corpus conditioned on domain & complexity
-        corpus = self.gen(domain, complex, num_sess=size)
-
         # txt_file = "{}-{}-{}.{}".format(domain_spec.name,
         #                                complexity_spec.__name__,
         #                                size, 'txt')
 
+        profile_file = "{}-{}-{}.{}".format(domain_spec.name,
+                                            complexity_spec.__name__,
+                                            size, 'profile.json')
+        profile_file = os.path.join(name, profile_file)
+
+        if stream:
+            jsonl_file = "{}-{}-{}.{}".format(domain_spec.name,
+                                              complexity_spec.__name__,
+                                              size, 'jsonl')
+            jsonl_file = os.path.join(name, jsonl_file)
+
+            dialogs = self.iter_dialogs(domain, complex, seed=seed, limit=size, workers=workers,
+                                        profiler=profiler)
+            if verbose:
+                dialogs = self._progress(dialogs, size)
+            stats = CorpusStats()
+            self.pprint_jsonl(dialogs, domain_spec, jsonl_file, stats=stats)
+            if verbose:
+                stats.pprint()
+            if profiler is not None:
+                profiler.dump(profile_file)
+            return stats
+
+        # generate the corpus conditioned on domain & complexity
+        if verbose:
+            corpus = self.gen(domain, complex, num_sess=size, workers=workers, seed=seed, profiler=profiler)
+        else:
+            corpus = list(self.iter_dialogs(domain, complex, seed=seed, limit=size, workers=workers,
+                                            profiler=profiler))
+
         json_file = "{}-{}-{}.{}".format(domain_spec.name,
                                          complexity_spec.__name__,
                                          size, 'json')
 
         json_file = os.path.join(name, json_file)
         self.pprint(corpus, True, domain_spec, json_file)
-        self.print_stats(corpus)
+        stats = CorpusStats()
+        for d in corpus:
+            stats.add(d)
+        if verbose:
+            stats.pprint()
+        if profiler is not None:
+            profiler.dump(profile_file)
+        return stats
+
+    def _gen_chunks(self, out_dir, domain_spec, complexity_spec, size, chunk_size, workers=1, seed=None,
+                    profiler=None, db_seed=None, snapshot_dir=None, db_path=None, domain_path=None, verbose=True):
+        """
+        Generate a corpus into out_dir as part-XXXXX.jsonl chunks. manifest.json records the seed and the
+        number of finished dialogs, and is only updated after a chunk is completely written. A restart
+        skips the finished chunks and, since every dialog has its own seed, produces the same files as
+        an uninterrupted run.
+        """
+        manifest_file = os.path.join(out_dir, "manifest.json")
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if seed is not None and seed != manifest['seed']:
+                raise ValueError("Seed %d does not match the seed %d of %s" % (seed, manifest['seed'], out_dir))
+            if size != manifest['size'] or chunk_size != manifest['chunk_size'] \
+                    or self.state_mode != manifest.get('state_mode', self.STATE_FULL):
+                raise ValueError("Size, chunk size or state mode does not match the manifest of %s" % out_dir)
+            seed = manifest['seed']
+            if db_seed is not None and db_seed != manifest.get('db_seed', seed):
+                raise ValueError("Database seed %d does not match the manifest of %s" % (db_seed, out_dir))
+            db_seed = manifest.get('db_seed', seed)
+        else:
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            if seed is None:
+                seed = int(np.random.randint(0, 2**31-1))
+            if db_seed is None:
+                db_seed = seed
+            manifest = {'domain': domain_spec.name, 'complexity': complexity_spec.__name__,
+                        'size': size, 'chunk_size': chunk_size, 'seed': seed,
+                        'db_seed': db_seed, 'state_mode': self.state_mode, 'num_finished': 0, 'chunks': []}
+            with open(os.path.join(out_dir, "meta.json"), "w") as f:
+                json.dump(domain_spec.to_dict(), f, indent=2)
+            self._save_manifest(manifest, manifest_file)
+
+        start = manifest['num_finished']
+        if start < size:
+            # the database is sampled from a recorded seed as well, so a restart sees the same one
+            if domain_path is not None:
+                domain = Domain.load(domain_path)
+            else:
+                domain = Domain(domain_spec, seed=db_seed, snapshot_dir=snapshot_dir, db_path=db_path)
+            complex = Complexity(complexity_spec)
+            dialogs = self.iter_dialogs(domain, complex, seed=seed, start=start, limit=size-start, workers=workers,
+                                        profiler=profiler)
+            if verbose:
+                dialogs = self._progress(dialogs, size-start)
+
+            while start < size:
+                stop = min(start+chunk_size, size)
+                chunk_file = "part-%05d.jsonl" % (start // chunk_size)
+                chunk_path = os.path.join(out_dir, chunk_file)
+                with open(chunk_path + ".tmp", "w") as f:
+                    for d in itertools.islice(dialogs, stop-start):
+                        f.write(self._dump_line(d))
+                os.rename(chunk_path + ".tmp", chunk_path)
+
+                manifest['num_finished'] = stop
+                manifest['chunks'].append(chunk_file)
+                self._save_manifest(manifest, manifest_file)
+                start = stop
+
+        stats = CorpusStats()
+        for chunk_file in manifest['chunks']:
+            with open(os.path.join(out_dir, chunk_file)) as f:
+                for line in f:
+                    stats.add(json.loads(line))
+        if verbose:
+            stats.pprint()
+        return stats
+
+    @staticmethod
+    def _save_manifest(manifest, manifest_file):
+        # write then rename, so a crash never leaves a half written manifest
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(manifest_file + ".tmp", manifest_file)
+
+
+class CorpusStats(object):
+    """
+    Running statistics of a corpus that are updated one dialog at a time.
+
+    :ivar num_dialogs: the number of dialogs seen
+    :ivar total_len: the total number of turns
+    :ivar max_len: the length of the longest dialog
+    :ivar kb_cnt: the number of turns that query the KB
+    :ivar ratio_sum: the sum over dialogs of the ratio of KB turns
+    """
+
+    def __init__(self):
+        self.num_dialogs = 0
+        self.total_len = 0
+        self.max_len = 0
+        self.kb_cnt = 0.
+        self.ratio_sum = 0.
+
+    def add(self, dialog):
+        local_cnt = 0.
+        for t in dialog:
+            if 'QUERY' in t['utt']:
+                local_cnt += 1
+        self.num_dialogs += 1
+        self.total_len += len(dialog)
+        self.max_len = max(self.max_len, len(dialog))
+        self.kb_cnt += local_cnt
+        self.ratio_sum += local_cnt/len(dialog)
+
+    def pprint(self):
+        print("%d dialogs" % self.num_dialogs)
+        print("Avg len {} Max Len {}".format(float(self.total_len)/self.num_dialogs, self.max_len))
+        print(self.kb_cnt/self.total_len)
+        print(self.ratio_sum/self.num_dialogs)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# author: Tiancheng Zhao
+from timeit import default_timer as timer
+from array import array
+import numpy as np
+import json
+
+
+class StageProfiler(object):
+    """
+    Opt-in instrumentation of the generation loop. It keeps the cumulative time and number of calls of
+    every stage of a turn, plus the number of turns and the latency of every dialog.
+
+    :cvar STAGES: the instrumented stages in the order they run in a system-user exchange
+    :ivar totals: stage -> [seconds, calls]
+    :ivar turns: the number of turns of each dialog
+    :ivar latencies: the seconds spent on each dialog
+    """
+
+    STAGES = ['sys.step', 'sys_nlg.generate_sent', 'usr.step',
+              'action_channel.transmit2sys', 'usr_nlg.generate_sent', 'word_channel.transmit2sys']
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self):
+        self.totals = {stage: [0.0, 0] for stage in self.STAGES}
+        self.turns = array('i')
+        self.latencies = array('d')
+
+    def timed(self, stage, func):
+        """
+        :return: func wrapped to add its time to stage on every call
+        """
+        total = self.totals.setdefault(stage, [0.0, 0])
+
+        def wrapper(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                total[0] += timer() - start
+                total[1] += 1
+        return wrapper
+
+    def add_dialog(self, num_turns, latency):
+        self.turns.append(num_turns)
+        self.latencies.append(latency)
+
+    def merge(self, other):
+        """
+        Add the measurements of another profiler, e.g. the one of a worker process.
+        """
+        for stage, (seconds, calls) in other.totals.items():
+            total = self.totals.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += calls
+        self.turns.extend(other.turns)
+        self.latencies.extend(other.latencies)
+
+    def to_dict(self):
+        stages = {}
+        for stage, (seconds, calls) in self.totals.items():
+            stages[stage] = {'calls': calls, 'seconds': seconds,
+                             'us_per_call': 1e6 * seconds / calls if calls > 0 else 0.0}
+
+        results = {'stages': stages, 'num_dialogs': len(self.turns)}
+        if len(self.turns) > 0:
+            results['turns'] = self._summary(np.array(self.turns, dtype=np.float64))
+            results['latency_ms'] = self._summary(np.array(self.latencies, dtype=np.float64) * 1000.0)
+        return results
+
+    def _summary(self, values):
+        summary = {'mean': float(np.mean(values)), 'max': float(np.max(values))}
+        for p in self.PERCENTILES:
+            summary['p%d' % p] = float(np.percentile(values, p))
+        return summary
+
+    def dump(self, output_file):
+        with open(output_file, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
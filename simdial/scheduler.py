@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# author: Tiancheng Zhao
+from simdial.generator import Generator
+from simdial import complexity
+import multiprocessing
+import importlib
+import logging
+import json
+import time
+import numpy as np
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class Job(object):
+    """
+    One gen_corpus call of a scheduler manifest.
+
+    :ivar name: the output folder, e.g. train or test
+    :ivar domain: the import path of a DomainSpec class, e.g. multiple_domains.RestSpec
+    :ivar complexity: a ComplexitySpec name in simdial.complexity or the import path of one
+    :ivar size: the number of dialogs
+    :ivar kwargs: extra keyword arguments of gen_corpus, i.e. seed, stream, chunk_size, db_seed, snapshot_dir,
+    db_path and domain_path
+    :ivar state_mode: the Generator state mode, see Generator.STATE_MODES
+    """
+
+    OPTIONAL_KEYS = ['seed', 'stream', 'chunk_size', 'db_seed', 'snapshot_dir', 'db_path',
+                     'domain_path', 'state_mode']
+
+    def __init__(self, name, domain, complexity, size, **kwargs):
+        unknown = [k for k in kwargs.keys() if k not in self.OPTIONAL_KEYS]
+        if unknown:
+            raise ValueError("Unknown job options %s" % unknown)
+        self.name = name
+        self.domain = domain
+        self.complexity = complexity
+        self.size = size
+        self.state_mode = kwargs.pop('state_mode', Generator.STATE_FULL)
+        self.kwargs = kwargs
+
+    def cost(self):
+        """
+        :return: the estimated amount of work, used to schedule the largest jobs first
+        """
+        return self.size
+
+    def describe(self):
+        return "%s/%s-%s-%d" % (self.name, self.domain.split(".")[-1], self.complexity.split(".")[-1], self.size)
+
+    def run(self):
+        """
+        Generate the corpus of this job in the current process.
+
+        :return: the CorpusStats of the corpus
+        """
+        domain_spec = _import_object(self.domain)()
+        if "." in self.complexity:
+            complexity_spec = _import_object(self.complexity)
+        else:
+            complexity_spec = getattr(complexity, self.complexity)
+        generator = Generator(state_mode=self.state_mode)
+        return generator.gen_corpus(self.name, domain_spec, complexity_spec, self.size, verbose=False, **self.kwargs)
+
+
+def _import_object(path):
+    module_name, obj_name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), obj_name)
+
+
+def _run_job(job):
+    # forked workers inherit the same global random state, so jobs without a seed need fresh entropy
+    np.random.seed()
+    start_time = time.time()
+    stats = job.run()
+    return job, stats.num_dialogs, time.time() - start_time
+
+
+class Scheduler(object):
+    """
+    Run a list of corpus generation jobs concurrently on a pool of local worker processes. Each job is
+    generated by a single worker, and the largest jobs are started first to balance the load.
+
+    A manifest is a JSON (or YAML if PyYAML is installed) file of the form
+    {"jobs": [{"name": "train", "domain": "multiple_domains.RestSpec", "complexity": "MixSpec", "size": 2000}, ...]}
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, jobs, workers=None):
+        """
+        :param jobs: a list of Job
+        :param workers: the number of worker processes. None to use one per core
+        """
+        self.jobs = jobs
+        self.workers = multiprocessing.cpu_count() if workers is None else workers
+
+    @classmethod
+    def from_manifest(cls, manifest_file, workers=None):
+        with open(manifest_file) as f:
+            if manifest_file.endswith((".yaml", ".yml")):
+                if yaml is None:
+                    raise ImportError("PyYAML is required to read %s" % manifest_file)
+                manifest = yaml.safe_load(f)
+            else:
+                manifest = json.load(f)
+        jobs = [Job(**job) for job in manifest['jobs']]
+        return cls(jobs, workers=workers)
+
+    def run(self):
+        """
+        Run all the jobs and report the throughput of each one as it finishes.
+
+        :return: a list of (job, number of dialogs, seconds) in the finishing order
+        """
+        # longest processing time first, the stable sort keeps the manifest order for ties
+        jobs = sorted(self.jobs, key=lambda j: j.cost(), reverse=True)
+        results = []
+        start_time = time.time()
+
+        # one fresh process per job, so the memory of a large domain is released when its job is done
+        pool = multiprocessing.Pool(min(self.workers, max(len(jobs), 1)), maxtasksperchild=1)
+        try:
+            for job, num_dialogs, elapsed in pool.imap_unordered(_run_job, jobs):
+                results.append((job, num_dialogs, elapsed))
+                msg = "[%d/%d] %s: %d dialogs in %.1fs (%.1f dialogs/s)" % (
+                    len(results), len(jobs), job.describe(), num_dialogs, elapsed, num_dialogs / max(elapsed, 1e-6))
+                self.logger.info(msg)
+                print(msg)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        elapsed = time.time() - start_time
+        total = sum([n for _, n, _ in results])
+        msg = "%d jobs, %d dialogs in %.1fs (%.1f dialogs/s) with %d workers" % (
+            len(results), total, elapsed, total / max(elapsed, 1e-6), self.workers)
+        self.logger.info(msg)
+        print(msg)
+        return results
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# author: Tiancheng Zhao
+from collections import OrderedDict
+import numpy as np
+import logging
+import sqlite3
+import os
+
+
+class SqliteDatabase(object):
+    """
+    A Database backed by a local SQLite file, for large knowledge bases loaded from an external catalog.
+    It has the same select, refine, count, sample_unique_row and pprint interface as Database, plus
+    select_many to look up the queries of many dialogs together.
+
+    The file has one table "entries" with an INTEGER "uid" column numbered from 0, plus one INTEGER column
+    per slot named after the slot (without #). The values are ids into the slot vocabularies.
+
+    :ivar path: the SQLite file
+    :ivar usr_columns: the columns of the searchable attributes, in the order of the domain usr_slots
+    :ivar sys_columns: the columns of the non-searchable attributes, in the order of the domain sys_slots
+    :ivar num_rows: the number of entries
+    :ivar unique_rows: the distinct rows of the searchable attributes : 2D array
+    :ivar cache: LRU cache of SELECT : OrderedDict {query tuple -> (entries, index)}
+    """
+
+    logger = logging.getLogger(__name__)
+    CACHE_SIZE = 4096
+    CACHE_MAX_ROWS = 1 << 16
+    TABLE = "entries"
+
+    def __init__(self, path, usr_columns, sys_columns, cache_size=None, create_indexes=False):
+        """
+        :param path: an existing SQLite file
+        :param usr_columns: the column names of the searchable attributes
+        :param sys_columns: the column names of the non-searchable attributes
+        :param cache_size: the max number of cached SELECT results. None to use CACHE_SIZE, 0 to disable
+        :param create_indexes: if True, create the missing index of a searchable attribute in the file.
+        Otherwise the file is only read, and a missing index is only logged as a warning.
+        """
+        if not os.path.exists(path):
+            raise ValueError("No database file %s" % path)
+        self.path = path
+        self.usr_columns = list(usr_columns)
+        self.sys_columns = list(sys_columns)
+        self.num_usr_slots = len(self.usr_columns)
+        self.num_sys_slots = len(self.sys_columns)
+        self._conn = None
+        self._pid = None
+        # SELECT statement of every set of constrained attributes
+        self._statements = {}
+
+        conn = self._connect()
+        columns = set([row[1] for row in conn.execute('PRAGMA table_info("%s")' % self.TABLE)])
+        missing = [c for c in ['uid'] + self.usr_columns + self.sys_columns if c not in columns]
+        if missing:
+            raise ValueError("Database file %s misses the columns %s" % (path, missing))
+
+        # one index per searchable attribute, so that every constrain is an index lookup
+        indexed = set()
+        for row in conn.execute('PRAGMA index_list("%s")' % self.TABLE).fetchall():
+            index_columns = conn.execute('PRAGMA index_info("%s")' % row[1]).fetchall()
+            if index_columns:
+                indexed.add(index_columns[0][2])
+        unindexed = [c for c in self.usr_columns if c not in indexed]
+        if unindexed and create_indexes:
+            with conn:
+                for col in unindexed:
+                    conn.execute('CREATE INDEX "idx_%s" ON "%s" ("%s")' % (col, self.TABLE, col))
+        elif unindexed:
+            self.logger.warning("No index on the columns %s of %s, selecting them scans the table"
+                                % (unindexed, path))
+
+        self.num_rows = conn.execute('SELECT COUNT(*) FROM "%s"' % self.TABLE).fetchone()[0]
+        usr_cols = self._column_list(self.usr_columns)
+        self.unique_rows = np.array(conn.execute('SELECT DISTINCT %s FROM "%s" ORDER BY %s'
+                                                 % (usr_cols, self.TABLE, usr_cols)).fetchall(), dtype=np.int64)
+
+        self.cache_size = self.CACHE_SIZE if cache_size is None else cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @classmethod
+    def from_database(cls, db, path, usr_columns, sys_columns, **kwargs):
+        """
+        Write a numpy Database into a new SQLite file, e.g. to share it with other tools.
+
+        :param db: a Database
+        :param path: the SQLite file to create
+        :return: a SqliteDatabase of the file
+        """
+        if os.path.exists(path):
+            raise ValueError("Database file %s already exists" % path)
+        columns = ['uid'] + list(usr_columns) + list(sys_columns)
+        conn = sqlite3.connect(path)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE "%s" (%s)' % (cls.TABLE, ", ".join(
+                    ['"uid" INTEGER PRIMARY KEY'] + ['"%s" INTEGER' % c for c in columns[1:]])))
+                sql = 'INSERT INTO "%s" VALUES (%s)' % (cls.TABLE, ", ".join(["?"] * len(columns)))
+                for start in range(0, db.num_rows, db.CHUNK_ROWS):
+                    stop = min(start + db.CHUNK_ROWS, db.num_rows)
+                    rows = np.column_stack((db.sys_table[start:stop, 0], db.table[start:stop],
+                                            db.sys_table[start:stop, 1:])).tolist()
+                    conn.executemany(sql, rows)
+        finally:
+            conn.close()
+        kwargs.setdefault('create_indexes', True)
+        return cls(path, usr_columns, sys_columns, **kwargs)
+
+    def _connect(self):
+        # a connection cannot be shared with forked worker processes, so each process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, cached_statements=256)
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        return state
+
+    @staticmethod
+    def _column_list(columns):
+        return ", ".join(['"%s"' % c for c in columns])
+
+    def _statement(self, constrained):
+        """
+        :param constrained: the tuple of the constrained attribute ids
+        :return: the parametrized SELECT of these constrains. sqlite3 keeps it compiled across calls
+        """
+        sql = self._statements.get(constrained)
+        if sql is None:
+            where = " AND ".join(['"%s" = ?' % self.usr_columns[a_id] for a_id in constrained])
+            sql = 'SELECT %s FROM "%s"%s ORDER BY "uid"' % (self._column_list(['uid'] + self.sys_columns),
+                                                           self.TABLE, " WHERE " + where if where else "")
+            self._statements[constrained] = sql
+        return sql
+
+    def sample_unique_row(self, rng=None):
+        """
+        :param rng: the numpy RandomState to sample from. None to use the global one
+        :return: a unique row in the searchable table
+        """
+        rng = np.random if rng is None else rng
+        return self.unique_rows[rng.randint(0, len(self.unique_rows))]
+
+    def select(self, query, return_index=False):
+        """
+        Filter the database entries according the query. The results of the recent queries are cached
+        and shared between the callers, so the returned entries are read-only.
+
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :param return_index: if return the db index
+        :return return a list system_entries and (optional)index that satisfy all constrains
+        """
+        return self.select_many([query], return_index=return_index)[0]
+
+    def select_many(self, queries, return_index=False):
+        """
+        Batched select of the queries of many dialogs. Every distinct query is looked up once, and the ones
+        missing from the cache are run in one transaction.
+
+        :param queries: a list of queries, see select
+        :param return_index: if return the db index
+        :return: a list of the select results of the queries
+        """
+        keys = [tuple(None if q is None else int(q) for q in query) for query in queries]
+        results = {}
+        missing = []
+        for key in keys:
+            if key in results:
+                continue
+            result = self.cache.pop(key, None)
+            if result is None:
+                self.cache_misses += 1
+                missing.append(key)
+            else:
+                self.cache_hits += 1
+                self.cache[key] = result
+            # a repeated query is looked up and run only once
+            results[key] = result
+
+        if missing:
+            conn = self._connect()
+            with conn:
+                for key in missing:
+                    constrained = tuple(a_id for a_id, q in enumerate(key) if q is not None)
+                    rows = conn.execute(self._statement(constrained), [key[a_id] for a_id in constrained]).fetchall()
+                    if rows:
+                        entries = np.array(rows, dtype=np.int64)
+                    else:
+                        entries = np.empty((0, self.num_sys_slots+1), dtype=np.int64)
+                    entries.flags.writeable = False
+                    results[key] = (entries, entries[:, 0])
+                    if self.cache_size > 0 and len(entries) <= self.CACHE_MAX_ROWS:
+                        if len(self.cache) >= self.cache_size:
+                            self.cache.popitem(last=False)
+                        self.cache[key] = results[key]
+
+        outputs = []
+        for key in keys:
+            valid_entries, valid_idx = results[key]
+            outputs.append((valid_entries, valid_idx.tolist()) if return_index else valid_entries)
+        return outputs
+
+    def refine(self, query, valid_idx, constrains):
+        """
+        Select the entries of query. The indexes of SQLite already make it cheap, so the rows of the
+        previous select are not used, see Database.refine.
+
+        :return: the read-only entries and the row ids that satisfy query
+        """
+        valid_entries = self.select(query)
+        return valid_entries, valid_entries[:, 0]
+
+    def count(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the number of rows that satisfy all constrains
+        """
+        constrained = [(self.usr_columns[a_id], int(q)) for a_id, q in enumerate(query) if q is not None]
+        if len(constrained) == 0:
+            return self.num_rows
+        where = " AND ".join(['"%s" = ?' % col for col, _ in constrained])
+        sql = 'SELECT COUNT(*) FROM "%s" WHERE %s' % (self.TABLE, where)
+        return self._connect().execute(sql, [q for _, q in constrained]).fetchone()[0]
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def pprint(self):
+        """
+        print statistics of the database in a beautiful format.
+        """
+        self.logger.info("DB %s contains %d rows (%d unique ones), with %d attributes"
+                         % (self.path, self.num_rows, len(self.unique_rows), self.num_usr_slots))
+        if self.cache_hits + self.cache_misses > 0:
+            self.logger.info("SELECT cache: %d hits, %d misses, %d/%d entries"
+                             % (self.cache_hits, self.cache_misses, len(self.cache), self.cache_size))